@@ -0,0 +1,974 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import random
+import argparse
+import ipaddress
+from functools import partial
+from pathlib import Path
+
+CUR_DIR = Path(__file__).parent
+TOP_DIR = CUR_DIR.parent
+SRC_DIR = TOP_DIR / 'src'
+RULES_DIR = TOP_DIR / 'data/conf/vendor/rules'
+
+
+def setup_sys_path():
+    os.environ.setdefault('CREEPER_DBG_MODE', '1')  # no log files
+    sys.path.insert(0, str(SRC_DIR / 'third_party'))
+    sys.path.insert(0, str(SRC_DIR))
+
+
+def measure(func, items, rounds=3):
+    best = float('inf')
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - begin)
+
+    return best / len(items) * 1e9
+
+
+def report(name, ns_per_op, baseline=None):
+    line = f'{name:<24} {ns_per_op:10.1f} ns/op'
+    if baseline:
+        line += f'  (x{baseline / ns_per_op:.2f})'
+    print(line)
+
+
+def random_ipv4_list(count, seed=0):
+    rand = random.Random(seed)
+    return [str(ipaddress.IPv4Address(rand.getrandbits(32)))
+            for _ in range(count)]
+
+
+def random_ipv6_list(count, seed=0):
+    # Mostly global unicast (2000::/3), where the rule lists live.
+    rand = random.Random(seed)
+    return [str(ipaddress.IPv6Address(
+        (0b001 << 125 | rand.getrandbits(125))
+        if rand.random() < 0.9 else rand.getrandbits(128)))
+        for _ in range(count)]
+
+
+class LegacyCIDRList:
+    """The bucket scan that CIDRList used before the interval index."""
+
+    def __init__(self, data_file):
+        self.shift_bits = 0
+        self.ip_table = {}
+        self.init_table(data_file)
+
+    def get_table_id(self, ip_str):
+        ip_num = int(ipaddress.IPv4Address(ip_str))
+        return ip_num >> self.shift_bits
+
+    def init_table(self, data_file):
+        with open(data_file) as file:
+            data = [line.strip() for line in file if ':' not in line]
+
+        data = list(filter(None, data))
+        min_prelen = min(ipaddress.IPv4Network(i).prefixlen for i in data)
+        self.shift_bits = 32 - min_prelen
+        for item in data:
+            tab_id = self.get_table_id(item.split('/')[0])
+            record = ipaddress.IPv4Network(item)
+            self.ip_table.setdefault(tab_id, []).append(record)
+
+    def contains(self, ipv4):
+        tab_id = self.get_table_id(ipv4)
+        if tab_id not in self.ip_table:
+            return False
+
+        ip_addr = ipaddress.IPv4Address(ipv4)
+        for record in self.ip_table[tab_id]:
+            if ip_addr in record:
+                return True
+
+        return False
+
+
+def bench_cidr(args):
+    from creeper.impl.cidr_list import CIDRList
+
+    rule_file = Path(args.rules) / 'china_ip.txt'
+    begin = time.perf_counter()
+    legacy = LegacyCIDRList(rule_file)
+    legacy_load = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    cidr_list = CIDRList(rule_file)
+    new_load = time.perf_counter() - begin
+
+    ip_list = random_ipv4_list(args.count)
+    print(f'{rule_file}: {len(cidr_list)} merged ranges')
+    print(f'load: bucket {legacy_load * 1e3:.1f} ms, '
+          f'interval {new_load * 1e3:.1f} ms')
+    baseline = measure(legacy.contains, ip_list)
+    report('bucket scan', baseline)
+    report('interval bisect', measure(cidr_list.contains, ip_list), baseline)
+
+
+def bench_verdict(args):
+    from creeper.impl.cidr_list import CIDRList
+    from creeper.proxy.rules import rule_files, load_ip_verdicts, IP_DIRECT
+
+    rules_dir = Path(args.rules)
+    direct_ip = CIDRList(rules_dir / '../direct_ip.txt')
+    gfw_ip = CIDRList(rules_dir / 'gfw_ip.txt')
+    cn_ip = CIDRList(rules_dir / 'china_ip.txt')
+    ip_verdicts = load_ip_verdicts(rule_files(rules_dir))
+
+    def three_lists(ip):
+        if direct_ip.contains(ip):
+            return False
+
+        if gfw_ip.contains(ip):
+            return True
+
+        return not cn_ip.contains(ip)
+
+    def verdict_map(ip):
+        return ip_verdicts.lookup(ip) != IP_DIRECT
+
+    ip_list = random_ipv4_list(args.count)
+    ipv6_list = random_ipv6_list(args.count)
+    print(f'verdict map: {len(ip_verdicts)} ranges')
+
+    baseline = measure(three_lists, ip_list)
+    report('three CIDRLists', baseline)
+    report('verdict map', measure(verdict_map, ip_list), baseline)
+    baseline = measure(three_lists, ipv6_list)
+    report('three CIDRLists (IPv6)', baseline)
+    report('verdict map (IPv6)', measure(verdict_map, ipv6_list), baseline)
+
+
+class LegacyDomainList:
+    """The set of full names that DomainList used before the sorted keys."""
+
+    def __init__(self, path):
+        lines = path.read_text().splitlines()
+        lines = map(str.strip, lines)
+        lines = filter(None, lines)
+        self.rules = set(lines)
+
+    def memory_usage(self):
+        return sys.getsizeof(self.rules) + \
+            sum(map(sys.getsizeof, self.rules))
+
+    def contains(self, domain):
+        parts = domain.split('.')
+        for num in range(2, len(parts) + 1):
+            subdomian = '.'.join(parts[-num:])
+            if subdomian in self.rules:
+                return True
+        return False
+
+
+def random_domain_list(rules, count, seed=0):
+    rand = random.Random(seed)
+    rules = list(rules)
+    prefixes = ['www', 'api', 'cdn.static', 'a.b.c.d', 'img']
+    tlds = ['com', 'net', 'org', 'cn', 'io']
+    result = []
+    for _ in range(count):
+        if rand.random() < 0.5:
+            domain = rand.choice(rules)  # hit
+        else:
+            domain = f'{rand.getrandbits(40):x}.{rand.choice(tlds)}'
+        result.append(f'{rand.choice(prefixes)}.{domain}')
+
+    return result
+
+
+def bench_domain(args):
+    from creeper.utils import human_readable_size
+    from creeper.proxy.rules import DomainList
+
+    for name in ('china_domain', 'gfw_domain'):
+        path = Path(args.rules) / f'{name}.txt'
+        begin = time.perf_counter()
+        legacy = LegacyDomainList(path)
+        legacy_load = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        domain_list = DomainList.load(path)
+        new_load = time.perf_counter() - begin
+
+        domains = random_domain_list(legacy.rules, args.count)
+        legacy_mem = human_readable_size(legacy.memory_usage())
+        new_mem = human_readable_size(domain_list.memory_usage())
+        print(f'{path}: {len(legacy.rules)} rules, {len(domain_list)} keys')
+        print(f'load: set {legacy_load * 1e3:.1f} ms, '
+              f'sorted keys {new_load * 1e3:.1f} ms')
+        print(f'memory: set {legacy_mem}, sorted keys {new_mem}')
+        baseline = measure(legacy.contains, domains)
+        report('suffix set', baseline)
+        report('reversed bisect', measure(domain_list.contains, domains),
+               baseline)
+
+
+def bench_snapshot(args):
+    import tempfile
+    from creeper.proxy.rules import rule_files, load_rule_set, RuleSet
+
+    rules_dir = Path(args.rules)
+    files = rule_files(rules_dir)
+    begin = time.perf_counter()
+    RuleSet.compile(files)
+    compile_time = time.perf_counter() - begin
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_dir = Path(cache_dir)
+        begin = time.perf_counter()
+        load_rule_set(rules_dir, cache_dir)
+        first_time = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        rule_set = load_rule_set(rules_dir, cache_dir)
+        load_time = time.perf_counter() - begin
+
+        size = sum(p.stat().st_size for p in cache_dir.iterdir())
+        del rule_set
+
+    print(f'snapshot size: {size / 1024:.1f} KiB')
+    print(f'parse text rules:     {compile_time * 1e3:8.1f} ms')
+    print(f'compile + write:      {first_time * 1e3:8.1f} ms')
+    print(f'hash + mmap snapshot: {load_time * 1e3:8.1f} ms')
+
+
+class LegacyDnsParser:
+    """The StreamReader parser that dns_lookup used before DnsMessage."""
+
+    @staticmethod
+    def parse_string(reader, data):
+        res = ''
+        to_resue = None
+        bytes_left = 0
+        for ch in data:
+            if not ch:
+                break
+            if to_resue is not None:
+                res += reader.reuse(chr(to_resue) + chr(ch))
+                break
+            if bytes_left:
+                res += chr(ch)
+                bytes_left -= 1
+                continue
+            if (ch >> 6) == 0b11 and reader is not None:
+                to_resue = ch - 0b11000000
+            else:
+                bytes_left = ch
+            if res:
+                res += '.'
+        return res
+
+    class Reader:
+        def __init__(self, data):
+            self.data = data
+            self.pos = 0
+
+        def read(self, len_):
+            res = self.data[self.pos:self.pos + len_]
+            self.pos += len_
+            return res
+
+        def reuse(self, pos):
+            pos = int.from_bytes(pos.encode(), 'big')
+            return LegacyDnsParser.parse_string(None, self.data[pos:])
+
+    @classmethod
+    def parse(cls, res, req_len):
+        reader = cls.Reader(res)
+        data = reader.read(req_len)
+        result = {}
+        types = {1: 'A', 5: 'CNAME', 28: 'AAAA'}
+        for _ in range(int.from_bytes(data[6:8], 'big')):
+            reader.read(2)
+            type_ = types.get(int.from_bytes(reader.read(2), 'big'))
+            reader.read(2)
+            ttl = int.from_bytes(reader.read(4), 'big')
+            data = reader.read(int.from_bytes(reader.read(2), 'big'))
+            if type_ == 'A':
+                item = str(ipaddress.IPv4Address(data))
+            elif type_ == 'AAAA':
+                item = str(ipaddress.IPv6Address(data))
+            elif type_ == 'CNAME':
+                item = cls.parse_string(reader, data)
+            else:
+                continue
+            result.setdefault(type_, []).append(item)
+            result['ttl'] = min(ttl, result.get('ttl', ttl))
+        return result
+
+
+def sample_response(qname, count):
+    from creeper.impl.dns_message import MessageWriter, QUERY_TYPES, \
+        FLAG_QR, FLAG_RD
+
+    A = QUERY_TYPES['A']
+    writer = MessageWriter()
+    writer.add_question(qname, A)
+    for i in range(count):
+        writer.add_record(qname, A, 60, f'198.51.100.{i}')
+    return writer.to_bytes(0x1234, FLAG_QR | FLAG_RD)
+
+
+def bench_dns(args):
+    from creeper.impl.dns_message import DnsMessage
+
+    samples = [
+        ('A', sample_response('www.example.com', 2)),
+        ('round robin', sample_response('cdn.example.net', 8)),
+    ]
+    for name, message in samples:
+        req_len = message.index(b'\x00\x01\x00\x01') + 4
+        messages = [message] * args.count
+
+        def legacy_parse(data):
+            return LegacyDnsParser.parse(data, req_len)
+
+        print(f'{name}: {len(message)} bytes')
+        baseline = measure(legacy_parse, messages)
+        report('StreamReader', baseline)
+        new = measure(lambda i: DnsMessage(i).to_result(), messages)
+        report('memoryview', new, baseline)
+        print(f'{len(message) / new * 1e3:.1f} MB/s parsed')
+
+
+class StubDnsServer(asyncio.DatagramProtocol):
+    """A local DNS server: A records for any name, truncated over UDP for
+    names starting with "big" so the client asks again over TCP."""
+
+    def __init__(self):
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def response(self, data, truncated=False):
+        from creeper.impl.dns_message import DnsMessage, make_response
+
+        self.queries += 1
+        query = DnsMessage(data)
+        question = query.questions[0]
+        records = [(question.name, question.type, 300, f'10.0.0.{i}')
+                   for i in range(1, 21)]
+        return make_response(query, records, truncated=truncated)
+
+    def datagram_received(self, data, addr):
+        big = data[13:16] == b'big'  # after the header and a length
+        self.transport.sendto(self.response(data, big), addr)
+
+    async def serve_tcp(self, reader, writer):
+        size = int.from_bytes(await reader.readexactly(2), 'big')
+        response = self.response(await reader.readexactly(size))
+        writer.write(len(response).to_bytes(2, 'big') + response)
+        await writer.drain()
+        writer.close()
+
+
+async def start_stub_dns():
+    loop = asyncio.get_running_loop()
+    transport, stub = await loop.create_datagram_endpoint(
+        StubDnsServer, local_addr=('127.0.0.1', 0))
+    port = transport.get_extra_info('sockname')[1]
+    tcp_server = await asyncio.start_server(
+        stub.serve_tcp, '127.0.0.1', port)
+    return stub, f'127.0.0.1:{port}', tcp_server
+
+
+async def measure_lan_client(count):
+    from creeper.impl.dns_lookup import UdpDnsClient
+
+    stub, server, tcp_server = await start_stub_dns()
+    client = UdpDnsClient(server, max_inflight=8)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[
+        client.query(f'host{i}.example.com') for i in range(count)])
+    elapsed = time.perf_counter() - begin
+    print(f'UDP: {count} queries, 8 in flight, '
+          f'{count / elapsed:8.0f} queries/s')
+
+    begin = time.perf_counter()
+    for i in range(count // 10):
+        await client.query(f'big{i}.example.com')
+    elapsed = time.perf_counter() - begin
+    print(f'truncated, asked again over TCP: '
+          f'{count // 10 / elapsed:8.0f} queries/s')
+
+    await client.close()
+    tcp_server.close()
+    stub.transport.close()
+
+
+async def measure_lan_race(lookups):
+    """Cold lookups through SafeDNS, with a LAN server that never answers
+    ahead of a working one."""
+    import socket
+    from creeper.proxy import router
+
+    stub, server, tcp_server = await start_stub_dns()
+    # Bound but never read: queries to it time out.
+    dead_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dead_sock.bind(('127.0.0.1', 0))
+    dead = f'127.0.0.1:{dead_sock.getsockname()[1]}'
+
+    saved = router.LAN_DNS_SERVERS, router.DOH_SERVERS
+    router.LAN_DNS_SERVERS, router.DOH_SERVERS = [dead, server], []
+    try:
+        dns = router.SafeDNS()
+        times = []
+        for i in range(lookups):
+            begin = time.perf_counter()
+            await dns.resolve(f'cold{i}.example.com')
+            times.append(time.perf_counter() - begin)
+        status = dns.server_status()
+    finally:
+        router.LAN_DNS_SERVERS, router.DOH_SERVERS = saved
+        dead_sock.close()
+        tcp_server.close()
+        stub.transport.close()
+
+    print(f'{lookups} cold lookups, dead LAN server first '
+          f'(timeout {router.LAN_DNS_TIMEOUT}s, '
+          f'stagger {router.DOH_STAGGER}s)')
+    print('per lookup ms: ' + ' '.join(f'{i * 1e3:.0f}' for i in times))
+    print(f'dead server score {status[dead]["score"]:.2f}, '
+          f'{status[dead]["queries"]} queries, '
+          f'live server {status[server]["queries"]} queries')
+
+
+def bench_lan(args):
+    asyncio.run(measure_lan_client(min(args.count, 1000)))
+    asyncio.run(measure_lan_race(10))
+
+
+async def legacy_relay_stream(statistic,
+                              reader, writer, peer_reader, peer_writer):
+    """relay_stream before the adaptive reads: 1 KiB, drain every chunk."""
+    async def relay(reader, reader2, writer, is_out):
+        try:
+            while True:
+                line = await reader.read(1024)
+                if len(line) == 0:
+                    reader2.feed_eof()
+                    break
+                writer.write(line)
+                statistic(is_out, len(line))
+                await writer.drain()
+        except BaseException:
+            pass
+
+    await asyncio.gather(
+        relay(reader, peer_reader, peer_writer, True),
+        relay(peer_reader, reader, writer, False)
+    )
+
+
+async def measure_relay(relay, total):
+    """Download `total` bytes from a local source through `relay`."""
+    chunk = b'x' * (1024 * 256)
+
+    async def source(reader, writer):
+        left = total
+        while left > 0:
+            writer.write(chunk[:left])
+            left -= len(chunk)
+            await writer.drain()
+        writer.close()
+
+    async def proxy(reader, writer):
+        peer_reader, peer_writer = await asyncio.open_connection(
+            '127.0.0.1', source_port)
+        try:
+            await relay(lambda *_: None,
+                        reader, writer, peer_reader, peer_writer)
+        finally:
+            peer_writer.close()
+            writer.close()
+
+    source_server = await asyncio.start_server(source, '127.0.0.1', 0)
+    source_port = source_server.sockets[0].getsockname()[1]
+    proxy_server = await asyncio.start_server(proxy, '127.0.0.1', 0)
+    proxy_port = proxy_server.sockets[0].getsockname()[1]
+
+    begin, cpu_begin = time.perf_counter(), time.process_time()
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    received = 0
+    while True:
+        data = await reader.read(1024 * 256)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - begin
+    cpu = time.process_time() - cpu_begin
+    writer.close()
+
+    source_server.close()
+    proxy_server.close()
+    return received, elapsed, cpu
+
+
+def report_relay(name, total, elapsed, cpu):
+    # The client and the source run in this process too, so the CPU time
+    # is an upper bound for the relay itself.
+    gib = total / 1024 ** 3
+    print(f'{name:<24} {total / elapsed / 1024 ** 2:8.1f} MiB/s '
+          f'{cpu / gib:6.2f} CPU s/GiB')
+
+
+async def relay_pipe(statistic, reader, writer, peer_reader, peer_writer):
+    from creeper.impl.transport_pipe import pipe_streams
+
+    closed = asyncio.get_running_loop().create_future()
+    pipe_streams(statistic, reader, writer, peer_reader, peer_writer,
+                 lambda: closed.set_result(None))
+    await closed
+
+
+def bench_relay(args):
+    from creeper.impl.http_proxy import relay_stream, relay_with
+    from creeper.impl.socket_relay import SPLICE_ENABLED
+
+    total = args.count * 1024  # --count is in KiB here
+    engines = {
+        'stream 1 KiB': legacy_relay_stream,
+        'stream adaptive': relay_stream,
+        'socket recv_into': partial(relay_with, 'socket'),
+    }
+    if SPLICE_ENABLED:
+        engines['socket splice'] = partial(relay_with, 'splice')
+    engines['transport pipe'] = relay_pipe
+
+    print(f'relaying {total / 1024 ** 2:.0f} MiB over local sockets')
+    for name, relay in engines.items():
+        received, elapsed, cpu = asyncio.run(measure_relay(relay, total))
+        report_relay(name, received, elapsed, cpu)
+
+
+async def measure_tunnels(engine, count):
+    """Connections per second and bytes per idle tunnel through the
+    proxy server, or of direct connections when `engine` is None."""
+    import gc
+    import tracemalloc
+    from creeper.impl import http_proxy
+
+    async def echo(reader, writer):
+        while data := await reader.read(1024):
+            writer.write(data)
+        writer.close()
+
+    echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    echo_port = echo_server.sockets[0].getsockname()[1]
+
+    async def open_conn(host, port):
+        peer = await asyncio.open_connection(host, port)
+        return peer, lambda *_: None
+
+    started = asyncio.get_running_loop().create_future()
+    opt = {
+        'open_conn': open_conn,
+        'started': lambda server, addr: started.set_result(addr[1]),
+        'relay_engine': engine,
+    }
+    if engine is None:
+        server_task = None
+        port = echo_port
+    else:
+        server_task = asyncio.ensure_future(
+            http_proxy.server_loop('127.0.0.1', 0, opt))
+        port = await started
+
+    async def open_tunnel():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        if engine is not None:
+            writer.write(f'CONNECT 127.0.0.1:{echo_port} HTTP/1.1\r\n'
+                         '\r\n'.encode())
+            await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'ping')
+        await reader.readexactly(4)
+        return writer
+
+    async def close_all(writers):
+        for writer in writers:
+            writer.close()
+        await asyncio.sleep(0)
+
+    # Connection rate, a few at a time.
+    begin = time.perf_counter()
+    rounds = count // 10
+    for _ in range(rounds):
+        await close_all(await asyncio.gather(
+            *[open_tunnel() for _ in range(10)]))
+    rate = rounds * 10 / (time.perf_counter() - begin)
+
+    # Memory held by idle tunnels.
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    writers = [await open_tunnel() for _ in range(count)]
+    await asyncio.sleep(0.2)
+    gc.collect()
+    per_tunnel = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+
+    await close_all(writers)
+    await asyncio.sleep(0.5)
+    if server_task is not None:
+        server_task.cancel()
+        await asyncio.gather(server_task, return_exceptions=True)
+    echo_server.close()
+    return rate, per_tunnel
+
+
+def bench_tunnels(args):
+    from creeper.impl.socket_relay import SPLICE_ENABLED
+
+    engines = ['stream', 'socket', 'pipe']
+    if SPLICE_ENABLED:
+        engines.insert(2, 'splice')
+
+    count = min(args.count, 2000)
+    print(f'{count} tunnels, per tunnel bytes include the client side')
+    rate, base = asyncio.run(measure_tunnels(None, count))
+    print(f'{"direct (no proxy)":<24} {rate:8.0f} conn/s '
+          f'{base:8.0f} bytes/conn')
+    for engine in engines:
+        rate, per_tunnel = asyncio.run(measure_tunnels(engine, count))
+        print(f'{engine:<24} {rate:8.0f} conn/s {per_tunnel:8.0f} '
+              f'bytes/tunnel ({per_tunnel - base:+.0f} for the proxy)')
+
+
+async def legacy_read_head(reader):
+    """The head reading before HttpHead: a line at a time, then split for
+    the proxy and again for the API."""
+    header = b''
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        header += line
+        if line == b'\r\n':
+            break
+
+    items = header.decode().split('\r\n')
+    items = [i for i in items
+             if not i.lower().startswith('proxy-connection:')]
+    header = '\r\n'.join(items).encode()
+
+    fields = {}
+    for item in header.decode().split('\r\n')[1:]:
+        key, _, value = item.partition(':')
+        fields[key.lower()] = value.strip()
+    return header
+
+
+def sample_head(count):
+    lines = ['GET http://example.com/index.html?q=1 HTTP/1.1',
+             'Host: example.com',
+             'User-Agent: Mozilla/5.0 (X11; Linux x86_64)',
+             'Proxy-Connection: keep-alive']
+    lines += [f'X-Header-{i}: {"v" * 40}' for i in range(count)]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def bench_head(args):
+    from creeper.impl.http_head import read_http_head, HOP_BY_HOP
+
+    async def parse_head(reader):
+        head = await read_http_head(reader)
+        return head.to_bytes(HOP_BY_HOP)
+
+    async def run(read, data, rounds):
+        for _ in range(rounds):
+            reader = asyncio.StreamReader(limit=1024 * 64)
+            reader.feed_data(data)
+            reader.feed_eof()
+            await read(reader)
+
+    rounds = max(args.count // 100, 10)
+    for count in (8, 100, 1000):
+        data = sample_head(count)
+        results = []
+        for read in (legacy_read_head, parse_head):
+            begin = time.perf_counter()
+            asyncio.run(run(read, data, rounds))
+            results.append((time.perf_counter() - begin) / rounds * 1e9)
+
+        legacy, parsed = results
+        print(f'head of {len(data)} bytes')
+        report('readline loop', legacy)
+        report('readuntil + HttpHead', parsed, legacy)
+
+
+async def measure_keepalive(mode, count, concurrency=8):
+    """Requests per second through the proxy, alternating between two
+    origins: 'relay' opens a connection per request, as a relayed one is
+    pinned to its first host, 'forward' keeps the client connection and
+    opens one upstream per request, 'pool' reuses the upstreams too."""
+    from creeper.impl import http_proxy
+    from creeper.impl.http_forward import UpstreamPool
+
+    body = b'x' * 512
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(
+        body) + body
+    upstreams = 0
+
+    async def origin(reader, writer):
+        nonlocal upstreams
+        upstreams += 1
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                writer.write(response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    origins = [await asyncio.start_server(origin, '127.0.0.1', 0)
+               for _ in range(2)]
+    ports = [i.sockets[0].getsockname()[1] for i in origins]
+
+    async def open_conn(host, port):
+        peer = await asyncio.open_connection(host, port)
+        return peer, lambda *_: None
+
+    started = asyncio.get_running_loop().create_future()
+    pool = None
+    if mode != 'relay':
+        pool = UpstreamPool(max_idle=128 if mode == 'pool' else 0)
+    opt = {
+        'open_conn': open_conn,
+        'started': lambda server, addr: started.set_result(addr[1]),
+        'upstream_pool': pool,
+    }
+    server_task = asyncio.ensure_future(
+        http_proxy.server_loop('127.0.0.1', 0, opt))
+    port = await started
+
+    async def client(share):
+        reader = writer = None
+        for i in range(share):
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+            target = f'http://127.0.0.1:{ports[i % 2]}/{i}'
+            writer.write(f'GET {target} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                         '\r\n'.encode())
+            await reader.readuntil(b'\r\n\r\n')
+            await reader.readexactly(len(body))
+            if mode == 'relay':
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[client(count // concurrency)
+                           for _ in range(concurrency)])
+    rate = count // concurrency * concurrency / (time.perf_counter() - begin)
+
+    server_task.cancel()
+    await asyncio.gather(server_task, return_exceptions=True)
+    if pool is not None:
+        pool.close()
+    for server in origins:
+        server.close()
+    return rate, upstreams
+
+
+def bench_keepalive(args):
+    count = min(args.count, 20000)
+    print(f'{count} plain-HTTP requests over 2 origins')
+    for mode in ('relay', 'forward', 'pool'):
+        rate, upstreams = asyncio.run(measure_keepalive(mode, count))
+        print(f'{mode:<24} {rate:8.0f} req/s {upstreams:8d} upstreams')
+
+
+def fork_process(func, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def run_download_source(sock, size):
+    chunk = b'x' * size
+
+    async def serve(reader, writer):
+        writer.write(chunk)
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(serve, sock=sock)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run_proxy_worker(port, channel):
+    from creeper.impl import http_proxy
+    from creeper.components import statistic
+    from creeper.components.workers import WorkerReporter
+
+    async def open_conn(host, port):
+        peer = await asyncio.open_connection(host, port)
+        statistic.add_route_event('DIRECT', f'{host}:{port}')
+        return peer, lambda is_out, bytes_: statistic.on_transfer(
+            False, is_out, bytes_)
+
+    async def main():
+        opt = {
+            'open_conn': open_conn,
+            'relay_engine': 'pipe',
+            'reuse_port': True,
+        }
+        server = asyncio.ensure_future(
+            http_proxy.server_loop('127.0.0.1', port, opt))
+        await WorkerReporter(channel, lambda state: None, 0.2).run()
+        server.cancel()
+
+    asyncio.run(main())
+
+
+def run_load(proxy_port, source_port, count, concurrency, result_fd):
+    async def tunnel():
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', proxy_port)
+        writer.write(f'CONNECT 127.0.0.1:{source_port} HTTP/1.1\r\n'
+                     '\r\n'.encode())
+        await reader.readuntil(b'\r\n\r\n')
+        received = len(await reader.read())
+        writer.close()
+        return received
+
+    async def client(share):
+        return sum([await tunnel() for _ in range(share)])
+
+    async def main():
+        shares = [count // concurrency] * concurrency
+        received = await asyncio.gather(*map(client, shares))
+        os.write(result_fd, f'{sum(shares)} {sum(received)}\n'.encode())
+
+    asyncio.run(main())
+
+
+async def measure_workers(count, tunnels, size, loaders=2, concurrency=16):
+    import socket
+    from dataclasses import asdict
+    from creeper.components import statistic
+    from creeper.components.workers import WorkerPool
+
+    def listen_socket(reuse_port=False):
+        sock = socket.socket()
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('127.0.0.1', 0))
+        return sock
+
+    statistic.transfer = statistic.AllTransfers()
+    statistic.route_event.queue.clear()
+
+    source_sock = listen_socket()
+    source_sock.listen(1024)
+    source_port = source_sock.getsockname()[1]
+    # Holds the port for the workers, without accepting anything.
+    port_sock = listen_socket(reuse_port=True)
+    proxy_port = port_sock.getsockname()[1]
+
+    pids = [fork_process(run_download_source, source_sock, size)]
+    pool = WorkerPool(count, interval=0.2)
+    pool.fork(partial(run_proxy_worker, proxy_port))
+    pool.start(lambda: {})
+    await asyncio.sleep(0.5)
+
+    result_r, result_w = os.pipe()
+    begin = time.perf_counter()
+    loader_pids = [
+        fork_process(run_load, proxy_port, source_port,
+                     tunnels // loaders, concurrency, result_w)
+        for _ in range(loaders)]
+    loop = asyncio.get_running_loop()
+    for pid in loader_pids:
+        await loop.run_in_executor(None, os.waitpid, pid, 0)
+    elapsed = time.perf_counter() - begin
+
+    done, received = 0, 0
+    os.close(result_w)
+    with os.fdopen(result_r) as f:
+        for line in f:
+            tunnels_, bytes_ = map(int, line.split())
+            done += tunnels_
+            received += bytes_
+
+    await asyncio.sleep(0.5)  # the last reports
+    reported = asdict(statistic.transfer)['direct']['recv']
+    routes = len(statistic.route_event.queue)
+
+    pool.stop()
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
+    for pid in pids + list(pool.workers):
+        os.waitpid(pid, 0)
+    port_sock.close()
+    source_sock.close()
+    return done, received, reported, routes, elapsed
+
+
+def bench_workers(args):
+    from creeper.components.workers import is_supported
+
+    if not is_supported():
+        print('worker mode needs fork() and SO_REUSEPORT')
+        return
+
+    tunnels = min(args.count, 4000)
+    size = 1024 * 64
+    print(f'{tunnels} tunnels of {size // 1024} KiB, {os.cpu_count()} CPUs')
+    for count in (1, 2, 4):
+        done, received, reported, routes, elapsed = asyncio.run(
+            measure_workers(count, tunnels, size))
+        print(f'{count} workers {done / elapsed:8.0f} conn/s '
+              f'{received / elapsed / 1024 ** 2:8.1f} MiB/s  '
+              f'reported {reported}/{received} bytes, {routes} routes')
+
+
+COMMANDS = {
+    'cidr': bench_cidr,
+    'verdict': bench_verdict,
+    'domain': bench_domain,
+    'snapshot': bench_snapshot,
+    'dns': bench_dns,
+    'lan': bench_lan,
+    'relay': bench_relay,
+    'tunnels': bench_tunnels,
+    'workers': bench_workers,
+    'head': bench_head,
+    'keepalive': bench_keepalive,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='creeper micro benchmarks')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--rules', default=str(RULES_DIR),
+                        help='directory of the rule lists')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of lookups per round')
+    args = parser.parse_args()
+
+    setup_sys_path()
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,25 @@
 import sys
 import errno
 import asyncio
+from types import SimpleNamespace
 
-from creeper.utils import check_singleton
-from creeper.impl import http_proxy, proxy_socks
+from creeper.utils import check_singleton, unbracket_host
+from creeper.impl import http_proxy, proxy_socks, happy_eyeballs
+from creeper.impl.http_forward import UpstreamPool
 from creeper.env import ICON_DIR, \
     APP_NAME, APP_CONF, USER_CONF, ENV_NO_BACKEND
 from creeper.log import logger
 from creeper.proxy.router import Router
+from creeper.proxy.rules import load_rule_set
 from creeper.proxy.pac import PACServer
 from creeper.proxy.backend import backend_utilitys, Backend
 from creeper.components import statistic
+from creeper.components.warm_cache import WarmCache
+from creeper.components.dns_server import DnsServer, DNS_SERVER_CONF, \
+    make_fake_ip_pool
 from creeper.components.update import check_update
+from creeper.components.workers import WorkerPool, WorkerReporter, \
+    PEER_HEADER
 from creeper.http_api import get_api_filter
 from creeper.impl.win_tray_icon import start_tray_icon_menu
 from creeper.impl.win_utils import MsgBox, open_url, exit_app, restart_app
@@ -56,8 +64,38 @@ class App:
         self.app_host_name = host_name
         self.app_port = APP_CONF['main_port']
         self.router = Router()
+        self.warm_cache = WarmCache(self.router)
+        self.fake_ips = make_fake_ip_pool()
+        self.dns_server = DnsServer(
+            self.router, lambda: self.did_allow_lan, self.fake_ips)
         self.pac_server = PACServer(self)
         self.backend = None
+        self.loop = None
+        self.upstream_pool = self.make_upstream_pool()
+        self.relay_engine = self.get_relay_engine()
+        self.workers = WorkerPool()
+        self.api_server_task = None
+        self.api_port = None  # for the requests forwarded by the workers
+        if self.workers.count and self.fake_ips is not None:
+            logger.warning('workers disabled: fake IPs are per process')
+            self.workers.count = 0
+
+    @staticmethod
+    def get_relay_engine():
+        engine = APP_CONF.get('relay_engine', http_proxy.DEFAULT_RELAY_ENGINE)
+        if engine not in http_proxy.RELAY_ENGINES:
+            logger.warning(f'bad relay_engine: {engine!r}, using '
+                           f'{http_proxy.DEFAULT_RELAY_ENGINE!r}')
+            engine = http_proxy.DEFAULT_RELAY_ENGINE
+        return engine
+
+    @staticmethod
+    def make_upstream_pool():
+        # Plain-HTTP requests are forwarded one by one over pooled
+        # connections, or the whole client connection relayed when off.
+        conf = {'enabled': True, **APP_CONF.get('upstream_pool', {})}
+        if conf.pop('enabled'):
+            return UpstreamPool(**conf)
 
     @property
     def did_allow_lan(self):
@@ -88,16 +126,18 @@ class App:
     def make_connection_dns_error(host):
         statistic.on_route('DNS_ERROR', f'DNS_ERROR: {host}')
 
-    async def make_connection(self, route_type, host, port=None):
+    async def make_connection(self, route_type, host, port=None,
+                              addrs=None):
         if route_type == ROUTE_DNS_ERROR:
             return self.make_connection_dns_error(host)
 
         if host == 'localhost':
             remote = '127.0.0.1'
         else:
-            remote = host
+            remote = unbracket_host(host)
 
-        ip = None
+        # Already resolved while routing: dialed directly, no getaddrinfo.
+        ip = addrs[0] if addrs and addrs[0] != remote else None
 
         if self.is_all_direct():
             if route_type != ROUTE_ALL_DIRECT:
@@ -126,28 +166,71 @@ class App:
                 remote, port, self.backend.host, self.backend.port)
         else:
             statistic.on_route('DIRECT', route_log)
-            connection = await asyncio.open_connection(remote, port)
+            if addrs:
+                connection = await happy_eyeballs.open_connection(
+                    addrs, port)
+            else:
+                connection = await asyncio.open_connection(remote, port)
 
         def statistic_(is_out, bytes_):
             statistic.on_transfer(via_proxy, is_out, bytes_)
 
         return connection, statistic_
 
-    async def on_open_conn(self, host, port):
+    async def choose_fake_ip_route(self, domain):
+        # Handed out for a domain that goes through the proxy: the backend
+        # resolves the name. A direct route needs the real address.
+        if not self.is_all_direct():
+            if not self.smart_mode:
+                return ROUTE_ALL_PROXY, domain, None
+
+            via_proxy = self.router.known_route(domain)
+            if via_proxy is None:
+                via_proxy = await self.router.need_proxy(domain)
+            if via_proxy:
+                return ROUTE_SELECT_PROXY, domain, None
+
+        answer = await self.router.dns.resolve_cached(domain)
+        if not answer:
+            return ROUTE_DNS_ERROR, domain, None
+
+        route_type = ROUTE_ALL_DIRECT if self.is_all_direct() \
+            else ROUTE_SELECT_DIRECT
+        return route_type, domain, answer[0]
+
+    async def choose_route(self, host):
+        """(route type, host to connect, addresses resolved for it)"""
+        domain = self.fake_ips and self.fake_ips.lookup(host)
+        if domain:
+            return await self.choose_fake_ip_route(domain)
+
         if self.is_all_direct():
-            return await self.make_connection(ROUTE_ALL_DIRECT, host, port)
+            return ROUTE_ALL_DIRECT, host, None
 
         if not self.smart_mode:
-            return await self.make_connection(ROUTE_ALL_PROXY, host, port)
+            return ROUTE_ALL_PROXY, host, None
 
-        via_proxy = await self.router.need_proxy(host)
+        via_proxy, addrs = await self.router.route(host)
 
         if via_proxy is None:
-            return await self.make_connection(ROUTE_DNS_ERROR, host)
+            return ROUTE_DNS_ERROR, host, None
         elif via_proxy:
-            return await self.make_connection(ROUTE_SELECT_PROXY, host, port)
+            return ROUTE_SELECT_PROXY, host, None
         else:
-            return await self.make_connection(ROUTE_SELECT_DIRECT, host, port)
+            return ROUTE_SELECT_DIRECT, host, addrs
+
+    async def on_open_conn(self, host, port):
+        route_type, host, addrs = await self.choose_route(host)
+        return await self.make_connection(route_type, host, port, addrs)
+
+    async def on_route(self, host, port):
+        # Pooled upstream connections are reused along the same route.
+        route = await self.choose_route(host)
+        return route[0], route
+
+    async def on_open_route(self, route, port):
+        route_type, host, addrs = route
+        return await self.make_connection(route_type, host, port, addrs)
 
     def on_server_started(self, server, addr):
         self.http_server = server
@@ -164,6 +247,11 @@ class App:
             'open_conn': self.on_open_conn,
             'req_filter': http_filter,
             'started': self.on_server_started,
+            'relay_engine': self.relay_engine,
+            'reuse_port': bool(self.workers.count),
+            'upstream_pool': self.upstream_pool,
+            'route': self.on_route,
+            'open_route': self.on_open_route,
         }
 
         retry_times = 0
@@ -182,6 +270,117 @@ class App:
                 else:
                     raise e
 
+    async def start_api_server(self):
+        started = self.loop.create_future()
+        opt = {
+            'req_filter': get_api_filter(self, forwarded=True),
+            'started': lambda server, addr: started.set_result(addr[1]),
+        }
+        self.api_server_task = asyncio.ensure_future(
+            http_proxy.server_loop(ADDR_LOCAL, 0, opt))
+        self.api_port = await started
+
+    def worker_state(self):
+        backend = self.backend
+        rules = self.router.rules
+        return {
+            'smart_mode': self.smart_mode,
+            'user_conf': dict(USER_CONF.conf),
+            'backend': backend and [backend.host, backend.port],
+            'api_port': self.api_port,
+            'rules': rules and rules.sources,
+        }
+
+    def on_worker_state(self, state):
+        self.smart_mode = state['smart_mode']
+        USER_CONF.replace_cached(state['user_conf'])
+        backend = state['backend']
+        self.backend = backend and SimpleNamespace(
+            host=backend[0], port=backend[1])
+        self.api_port = state['api_port']
+
+        # The rule files changed (/api/update_rules): load them again, from
+        # the snapshot the coordinator wrote.
+        rules = self.router.rules
+        if state['rules'] and rules is not None and \
+                rules.sources != state['rules']:
+            self.router.start_loading()
+
+    async def forward_api_request(self, reader, writer, head):
+        if self.api_port is None:
+            return
+
+        peer_ip = writer.get_extra_info('peername')[0]
+        header = head.to_bytes(extra=[(PEER_HEADER, peer_ip)])
+
+        peer_reader, peer_writer = await asyncio.open_connection(
+            ADDR_LOCAL, self.api_port)
+        try:
+            peer_writer.write(header)
+            await http_proxy.relay_stream(
+                lambda *_: None, reader, writer, peer_reader, peer_writer)
+        finally:
+            peer_writer.close()
+
+    def get_worker_filter(self):
+        http_filter = get_api_filter(self)
+
+        async def worker_filter(reader, writer, tunnel_mode,
+                                host, port, path, head):
+            if tunnel_mode or host:
+                return await http_filter(reader, writer, tunnel_mode,
+                                         host, port, path, head)
+
+            # The API lives in the coordinator, with the state of the app.
+            await self.forward_api_request(reader, writer, head)
+            return True
+
+        return worker_filter
+
+    async def run_worker_async(self, channel):
+        self.loop = asyncio.get_running_loop()
+        self.router.start_loading()
+        self.router.dns.hosts_file.start()
+
+        # Routing needs the backend and the API port from the coordinator:
+        # the port is shared only once the first state has arrived.
+        first_state = self.loop.create_future()
+
+        def on_state(state):
+            self.on_worker_state(state)
+            if not first_state.done():
+                first_state.set_result(None)
+
+        reporter = asyncio.ensure_future(
+            WorkerReporter(channel, on_state).run())
+        await asyncio.wait(
+            [first_state, reporter], return_when=asyncio.FIRST_COMPLETED)
+        if reporter.done():
+            return reporter.result()
+
+        opt = {
+            'open_conn': self.on_open_conn,
+            'req_filter': self.get_worker_filter(),
+            'relay_engine': self.relay_engine,
+            'reuse_port': True,
+            'upstream_pool': self.upstream_pool,
+            'route': self.on_route,
+            'open_route': self.on_open_route,
+        }
+        server = asyncio.ensure_future(http_proxy.server_loop(
+            self.app_host, self.app_port, opt))
+
+        # Ends with the coordinator, or when the port can not be bound.
+        done, pending = await asyncio.wait(
+            [server, reporter], return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+
+    def run_worker(self, channel):
+        asyncio.run(self.run_worker_async(channel))
+
     async def init_backend(self):
         backend_utilitys.check()
         self.backend = Backend()
@@ -277,6 +476,10 @@ class App:
 
     def handle_command(self, command):
         icon = self.tray_icon
+        if command in ('restart', 'exit'):
+            self.warm_cache.save_from_thread(self.loop)
+            self.workers.stop()
+
         if command == 'restart':
             icon.destroy()
             restart_app()
@@ -302,12 +505,35 @@ class App:
         if USER_CONF.enable_proxy is None:
             USER_CONF.enable_proxy = True
 
+        self.loop = asyncio.get_running_loop()
+        self.router.start_loading()
+        self.router.dns.hosts_file.start()
+        self.warm_cache.start()
+        try:
+            await self.serve()
+        finally:
+            # Also when the server gives up or the loop is interrupted, not
+            # only from the tray menu.
+            self.warm_cache.save_safe()
+
+    async def serve(self):
+        if DNS_SERVER_CONF['enabled']:
+            await self.dns_server.start_safe()
         self.init_tray_icon()
         if not ENV_NO_BACKEND:
             await self.init_backend()
 
+        if self.workers.count:
+            await self.start_api_server()
+            self.workers.start(self.worker_state)
+
         check_update(self.tray_icon)
         await self.start_server()
 
     def run(self):
+        if self.workers.count:
+            # Compiled once here, the workers map the same snapshot.
+            load_rule_set()
+            self.workers.fork(self.run_worker)
+
         asyncio.run(self.run_async())
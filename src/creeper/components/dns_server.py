@@ -0,0 +1,247 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from ipaddress import ip_address
+
+from creeper.log import logger
+from creeper.utils import write_drain, readable_exc
+from creeper.env import APP_CONF
+from creeper.impl.dns_lookup import split_server
+from creeper.impl.fake_ip import FakeIPPool
+from creeper.impl.dns_message import DnsMessage, DnsFormatError, \
+    make_response, QUERY_TYPES, CLASS_IN, RCODE_NOERROR, RCODE_FORMERR, \
+    RCODE_SERVFAIL, RCODE_NXDOMAIN, RCODE_NOTIMP, RCODE_REFUSED
+from creeper.proxy.router import is_domain_name
+
+DNS_SERVER_CONF = {
+    'enabled': False,
+    'listen': '127.0.0.1:53',
+    'doh_endpoint': False,
+    'fake_ip': False,
+    'fake_ip_range': '198.18.0.0/15',
+    'fake_ip_max': 65536,
+    **APP_CONF.get('dns_server', {}),
+}
+
+ADDRESS_TYPES = {
+    QUERY_TYPES['A']: 4,
+    QUERY_TYPES['AAAA']: 6,
+}
+FAMILY_QTYPES = {4: 'A', 6: 'AAAA'}
+
+LOCAL_TTL = 60  # for names from the hosts file
+FAKE_IP_TTL = 60
+UDP_MAX_SIZE = 512
+TCP_IDLE_TIMEOUT = 30
+
+
+@dataclass
+class QueryStats:
+    queries: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    family_lookups: int = 0
+    local: int = 0
+    fake_ip: int = 0
+    failures: int = 0
+    refused: int = 0
+    unsupported: int = 0
+    malformed: int = 0
+
+    def hit_ratio(self):
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else None
+
+
+class UdpServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.spawn(self.reply(data, addr))
+
+    async def reply(self, data, addr):
+        response = await self.server.handle(data, addr[0], UDP_MAX_SIZE)
+        if response is not None and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+
+class DnsServer:
+    """A stub DNS server for LAN clients, answered by SafeDNS.
+
+    Clients share the resolver cache of the router, so a domain is looked
+    up once for all of them. Only A and AAAA queries are resolved, other
+    types are refused, so that clients ask their next server rather than
+    cache an empty answer. Peers other than loopback are served only
+    while LAN access is allowed.
+
+    With `fake_ips`, domains known to go through the proxy are not resolved
+    at all: they get an address from the pool, which the proxy maps back
+    to the name, and the backend resolves it remotely.
+    """
+
+    def __init__(self, router, allow_lan=lambda: False, fake_ips=None):
+        self.router = router
+        self.dns = router.dns
+        self.allow_lan = allow_lan
+        self.fake_ips = fake_ips
+        self.stats = QueryStats()
+        self.tasks = set()
+        self.udp_transport = None
+        self.tcp_server = None
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def is_allowed(self, peer_ip):
+        try:
+            if ip_address(peer_ip).is_loopback:
+                return True
+        except ValueError:
+            pass
+
+        return self.allow_lan()
+
+    async def lookup(self, name, version):
+        # (rcode, addresses, TTL)
+        addrs = self.dns.find_local(name)
+        if addrs:
+            self.stats.local += 1
+            return RCODE_NOERROR, addrs, LOCAL_TTL
+
+        if not is_domain_name(name):
+            return RCODE_NXDOMAIN, (), 0
+
+        hit = self.dns.lookup_cache(name)
+        if hit is not None:
+            self.stats.cache_hits += 1
+            answer = hit[0]
+        else:
+            self.stats.cache_misses += 1
+            answer = await self.dns.resolve_shared(name)
+
+        if not answer:
+            self.stats.failures += 1
+            return RCODE_SERVFAIL, (), 0
+
+        # What the cached answer has left, not the TTL it was stored with.
+        addrs, ttl = answer
+        time_left = self.dns.cache.time_left(name)
+        if time_left is not None:
+            ttl = min(ttl, int(time_left))
+
+        # The shared cache keeps one family, IPv4 when there is any: the
+        # other one is looked up when a client asks for it.
+        if not any(ip_address(ip).version == version for ip in addrs):
+            self.stats.family_lookups += 1
+            answer = await self.dns.resolve_family_cached(
+                name, FAMILY_QTYPES[version])
+            if not answer:
+                return RCODE_NOERROR, (), 0
+            addrs, ttl = answer
+
+        return RCODE_NOERROR, addrs, ttl
+
+    async def answer(self, query):
+        if query.is_response:
+            return
+
+        if query.opcode != 0:
+            return make_response(query, rcode=RCODE_NOTIMP)
+
+        if len(query.questions) != 1:
+            return make_response(query, rcode=RCODE_FORMERR)
+
+        question = query.questions[0]
+        version = ADDRESS_TYPES.get(question.type)
+        if question.klass != CLASS_IN or version is None:
+            self.stats.unsupported += 1
+            return make_response(query, rcode=RCODE_REFUSED)
+
+        name = question.name.rstrip('.').lower()
+        if self.fake_ips is not None and self.router.known_route(name):
+            self.stats.fake_ip += 1
+            records = []
+            if version == 4:
+                ip = self.fake_ips.assign(name)
+                records.append((question.name, question.type, FAKE_IP_TTL, ip))
+            return make_response(query, records)
+
+        rcode, addrs, ttl = await self.lookup(name, version)
+        records = [(question.name, question.type, ttl, ip)
+                   for ip in addrs if ip_address(ip).version == version]
+
+        return make_response(query, records, rcode)
+
+    async def handle(self, data, peer_ip, max_size=None):
+        """The response to one query message, None to send nothing."""
+        self.stats.queries += 1
+        if not self.is_allowed(peer_ip):
+            self.stats.refused += 1
+            return
+
+        try:
+            query = DnsMessage(data)
+            response = await self.answer(query)
+        except DnsFormatError:
+            self.stats.malformed += 1
+            return
+
+        if response and max_size and len(response) > max_size:
+            response = make_response(query, truncated=True)
+        return response
+
+    async def handle_tcp(self, reader, writer):
+        peer_ip = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                head = await asyncio.wait_for(
+                    reader.readexactly(2), TCP_IDLE_TIMEOUT)
+                data = await reader.readexactly(int.from_bytes(head, 'big'))
+                response = await self.handle(data, peer_ip)
+                if response is None:
+                    break
+                await write_drain(
+                    writer, len(response).to_bytes(2, 'big') + response)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, listen=DNS_SERVER_CONF['listen']):
+        host, port = split_server(listen)
+        loop = asyncio.get_running_loop()
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: UdpServerProtocol(self), local_addr=(host, port))
+        self.tcp_server = await asyncio.start_server(
+            self.handle_tcp, host, port)
+        logger.info(f'DNS server on: {listen}')
+
+    async def start_safe(self):
+        try:
+            await self.start()
+        except OSError as e:
+            logger.error(f'DNS server: {readable_exc(e)}')
+
+    def close(self):
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+
+    def status(self):
+        status = dict(asdict(self.stats), hit_ratio=self.stats.hit_ratio())
+        if self.fake_ips is not None:
+            status['fake_ip_table'] = self.fake_ips.status()
+        return status
+
+
+def make_fake_ip_pool(conf=DNS_SERVER_CONF):
+    if conf['fake_ip']:
+        return FakeIPPool(conf['fake_ip_range'], conf['fake_ip_max'])
@@ -37,7 +37,7 @@ def on_transfer(is_proxy, is_out, bytes_):
             transfer.direct.recv += bytes_
 
 
-def on_route(type_, msg):
+def add_route_event(type_, msg):
     global route_event
 
     if route_event.full():
@@ -45,6 +45,10 @@ def on_route(type_, msg):
 
     now = time()
     route_event.put((now, type_, msg))
+
+
+def on_route(type_, msg):
+    add_route_event(type_, msg)
     logger.info(f'{type_}: {msg}')
 
 
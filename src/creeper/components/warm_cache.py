@@ -0,0 +1,184 @@
+import os
+import zlib
+import struct
+import socket
+import asyncio
+
+from creeper.log import logger
+from creeper.utils import now, readable_exc
+from creeper.env import CONF_DIR, FILE_WARM_CACHE
+
+MAGIC = b'CRPWARM2'
+# kind, expire_at, address size, address count, name length
+RECORD = struct.Struct('<BIBBB')
+
+KIND_DNS = 0
+KIND_DIRECT = 1
+KIND_PROXY = 2
+
+
+def pack_ip(ip):
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    return socket.inet_pton(family, ip)
+
+
+def unpack_ip(data):
+    family = socket.AF_INET6 if len(data) == 16 else socket.AF_INET
+    return socket.inet_ntop(family, data)
+
+
+def encode_entries(entries):
+    chunks = []
+    for kind, domain, addrs, expire_at in entries:
+        name = domain.encode()
+        packed = [pack_ip(i) for i in addrs]
+        size = len(packed[0])
+        packed = [i for i in packed if len(i) == size]  # one family
+        if len(name) > 255 or len(packed) > 255:
+            continue
+        chunks.append(RECORD.pack(kind, int(expire_at), size, len(packed),
+                                  len(name)))
+        chunks.extend(packed)
+        chunks.append(name)
+
+    return MAGIC + zlib.compress(b''.join(chunks))
+
+
+def decode_entries(data):
+    if not data.startswith(MAGIC):
+        raise ValueError('bad magic')
+
+    payload = zlib.decompress(data[len(MAGIC):])
+    offset = 0
+    while offset < len(payload):
+        kind, expire_at, size, count, name_len = \
+            RECORD.unpack_from(payload, offset)
+        offset += RECORD.size
+        addrs = []
+        for _ in range(count):
+            addrs.append(unpack_ip(payload[offset:offset + size]))
+            offset += size
+        domain = payload[offset:offset + name_len].decode()
+        offset += name_len
+        yield kind, domain, tuple(addrs), expire_at
+
+
+class WarmCache:
+    """Keeps DNS answers and domain verdicts across restarts.
+
+    Both caches are saved to a compact file periodically and on exit. On
+    startup they are loaded back with their remaining TTL, then the most
+    recently used domains are resolved again in the background.
+    """
+
+    SAVE_INTERVAL = 300
+    REFRESH_MAX = 500
+    REFRESH_CONCURRENCY = 4
+
+    def __init__(self, router, path=CONF_DIR / FILE_WARM_CACHE):
+        self.router = router
+        self.path = path
+        self.task = None
+        self.refresh_task = None
+        self.loaded = False  # saving before would drop the file's entries
+
+    def collect_entries(self):
+        for domain, answer, expire_at in self.router.dns.cache.entries():
+            if answer:
+                yield KIND_DNS, domain, answer[0], expire_at
+
+        for domain, verdict, expire_at in self.router.verdicts.entries():
+            via_proxy, addrs = verdict
+            kind = KIND_PROXY if via_proxy else KIND_DIRECT
+            yield kind, domain, addrs, expire_at
+
+    def save(self):
+        data = encode_entries(self.collect_entries())
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return []
+
+        current = now()
+        domains = []
+        for kind, domain, addrs, expire_at in decode_entries(data):
+            if expire_at <= current or not addrs:
+                continue
+
+            if kind == KIND_DNS:
+                answer = (addrs, int(expire_at - current))
+                self.router.dns.cache.set_until(domain, answer, expire_at)
+            else:
+                verdict = (kind == KIND_PROXY, addrs)
+                self.router.verdicts.set_until(domain, verdict, expire_at)
+                domains.append(domain)
+
+        return domains
+
+    async def refresh(self, domains):
+        router = self.router
+        if router.load_task:
+            # Cancelled when the loading starts over, the verdicts are then
+            # only added once the rules are ready.
+            await asyncio.gather(router.load_task, return_exceptions=True)
+
+        semaphore = asyncio.Semaphore(self.REFRESH_CONCURRENCY)
+
+        async def refresh_one(domain):
+            async with semaphore:
+                answer = await router.dns.resolve(domain)
+                if answer and router.is_ready:
+                    router.add_domain(domain, *answer)
+
+        recent = domains[-self.REFRESH_MAX:]
+        await asyncio.gather(*map(refresh_one, recent),
+                             return_exceptions=True)
+
+    async def run(self):
+        try:
+            domains = self.load()
+            logger.info(f'warm cache: {len(domains)} verdicts loaded')
+        except Exception as e:
+            logger.warning(f'warm cache: {readable_exc(e)}')
+            domains = []
+        self.loaded = True
+
+        if domains:
+            self.refresh_task = asyncio.create_task(self.refresh(domains))
+
+        while True:
+            await asyncio.sleep(self.SAVE_INTERVAL)
+            self.save_safe()
+
+    def save_safe(self):
+        if not self.loaded:
+            return
+
+        try:
+            self.save()
+        except Exception as e:
+            logger.warning(f'warm cache: {readable_exc(e)}')
+
+    def save_from_thread(self, loop, timeout=5):
+        """Saves on `loop` from another thread, or right here when the loop
+        is not running (not started yet, or already stopped)."""
+        if loop is None or not loop.is_running():
+            self.save_safe()
+            return
+
+        async def save():
+            self.save_safe()
+
+        try:
+            future = asyncio.run_coroutine_threadsafe(save(), loop)
+            future.result(timeout)
+        except Exception as e:
+            logger.warning(f'warm cache: {readable_exc(e)}')
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
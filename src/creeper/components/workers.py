@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import signal
+import socket
+import asyncio
+import traceback
+from dataclasses import asdict
+
+from creeper.log import logger
+from creeper.env import APP_CONF
+from creeper.components import statistic
+
+WORKERS_CONF = {
+    'count': 0,
+    'report_interval': 1.0,
+    **APP_CONF.get('workers', {}),
+}
+
+PEER_HEADER = 'X-Creeper-Peer'
+
+
+def is_supported():
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class Channel:
+    """JSON messages, one per line, over one end of a socket pair."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            sock=self.sock)
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode() + b'\n')
+
+    async def receive(self):
+        line = await self.reader.readline()
+        if line:
+            return json.loads(line)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.sock.close()
+
+
+def transfer_items(old, new):
+    # [is_proxy, is_out, bytes] for what changed between two snapshots.
+    items = []
+    for kind, is_proxy in (('direct', False), ('proxy', True)):
+        for field, is_out in (('recv', False), ('sent', True)):
+            bytes_ = new[kind][field] - old[kind][field]
+            if bytes_:
+                items.append([is_proxy, is_out, bytes_])
+
+    return items
+
+
+class WorkerPool:
+    """The coordinator of the worker processes.
+
+    Workers are forked before the event loop starts and each runs its own
+    proxy server on the shared port (SO_REUSEPORT), so the kernel spreads
+    the connections. They load the rules from the same mmapped snapshot,
+    report their transfer counters and route events here, where they are
+    merged into `statistic` for the HTTP API, and get the app state back
+    whenever it changes.
+    """
+
+    def __init__(self, count=WORKERS_CONF['count'],
+                 interval=WORKERS_CONF['report_interval']):
+        self.count = count if is_supported() else 0
+        self.interval = interval
+        self.workers = {}  # pid => channel
+        self.state = None
+        self.tasks = set()
+
+    def fork(self, run_worker):
+        """Fork the workers, each calls `run_worker(channel)` and exits."""
+        for _ in range(self.count):
+            sock, worker_sock = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                for channel in self.workers.values():
+                    channel.close()
+                self.workers.clear()
+                run_worker_exit(run_worker, Channel(worker_sock))
+
+            worker_sock.close()
+            self.workers[pid] = Channel(sock)
+
+        if self.workers:
+            logger.info(f'{len(self.workers)} workers forked')
+
+    def start(self, get_state):
+        for pid, channel in self.workers.items():
+            task = asyncio.ensure_future(self.serve(pid, channel))
+            self.tasks.add(task)
+        self.tasks.add(asyncio.ensure_future(self.push_state(get_state)))
+
+    async def serve(self, pid, channel):
+        await channel.open()
+        if self.state is not None:
+            channel.send({'state': self.state})
+
+        while (message := await channel.receive()) is not None:
+            for is_proxy, is_out, bytes_ in message.get('transfer', []):
+                statistic.on_transfer(is_proxy, is_out, bytes_)
+            for type_, msg in message.get('routes', []):
+                statistic.add_route_event(type_, msg)
+
+        logger.warning(f'worker {pid} exited')
+        self.workers.pop(pid, None)
+
+    async def push_state(self, get_state):
+        while True:
+            state = get_state()
+            if state != self.state:
+                self.state = state
+                for channel in self.workers.values():
+                    channel.send({'state': state})
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        for pid, channel in self.workers.items():
+            channel.close()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def status(self):
+        return {'count': self.count, 'alive': len(self.workers)}
+
+
+def run_worker_exit(run_worker, channel):
+    code = 0
+    try:
+        run_worker(channel)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+class WorkerReporter:
+    """The worker end: sends what `statistic` recorded since the last
+    report, and hands the state from the coordinator to `on_state`."""
+
+    def __init__(self, channel, on_state,
+                 interval=WORKERS_CONF['report_interval']):
+        self.channel = channel
+        self.on_state = on_state
+        self.interval = interval
+        self.transfer = asdict(statistic.transfer)
+        self.route_time = 0
+
+    def report(self):
+        transfer = asdict(statistic.transfer)
+        message = {}
+        items = transfer_items(self.transfer, transfer)
+        if items:
+            message['transfer'] = items
+        self.transfer = transfer
+
+        events = statistic.fetch_route_event(self.route_time)
+        if events:
+            event_list, self.route_time = events
+            message['routes'] = [[type_, msg] for _, type_, msg in event_list]
+
+        if message:
+            self.channel.send(message)
+
+    async def run_reports(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    async def run(self):
+        """Runs until the coordinator goes away."""
+        await self.channel.open()
+        reports = asyncio.ensure_future(self.run_reports())
+        try:
+            while (message := await self.channel.receive()) is not None:
+                state = message.get('state')
+                if state is not None:
+                    self.on_state(state)
+        finally:
+            reports.cancel()
@@ -53,6 +53,10 @@ class ConfMapping(SimpleNamespace):
             f.write(json.dumps(new_conf, indent=4))
         super().__setattr__('conf', new_conf)
 
+    def replace_cached(self, conf):
+        # Another process owns the file, only the copy here changes.
+        super().__setattr__('conf', conf)
+
 
 def _rewrite_main_port(conf):
     main_port = os.environ.get('CREEPER_MAIN_PORT')
@@ -77,6 +81,7 @@ ICON_DIR = _DATA_DIR / 'icons'
 BIN_DIR = _DATA_DIR / 'bin'
 TMP_DIR = _DATA_DIR / 'tmp'
 LOG_DIR = _DATA_DIR / 'log'
+RULES_CACHE_DIR = TMP_DIR / 'rules'
 
 _CONF_ROOT_DIR = _DATA_DIR / 'conf'
 CONF_DIR = _CONF_ROOT_DIR / 'user'
@@ -90,6 +95,7 @@ PATH_CACERT = CONF_VENDOR_DIR / 'cacert.pem'
 FILE_FEED_JSON = 'feed.json'
 FILE_SPEED_JSON = 'speed.json'
 FILE_CUR_NODE_JSON = 'cur_node.json'
+FILE_WARM_CACHE = 'warm_cache.bin'
 
 APP_CONF = _load_conf(PATH_APP_CONF, False)
 _rewrite_main_port(APP_CONF)
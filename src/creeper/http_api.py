@@ -24,6 +24,8 @@ from creeper.proxy.feed import add_feed, delete_feed, edit_feed, \
 from creeper.proxy.backend import backend_utilitys
 from creeper.components import statistic
 from creeper.components.measure import test_backend_speed
+from creeper.components.dns_server import DNS_SERVER_CONF
+from creeper.components.workers import PEER_HEADER
 from creeper.impl.win_utils import shell_execute
 from creeper.impl.net_time import get_net_time
 from scripts import install
@@ -33,6 +35,9 @@ MIME_CSS = 'text/css'
 MIME_JS = 'text/javascript; charset=utf-8'
 MIME_JSON = 'application/json'
 MIME_ICON = 'image/x-icon'
+MIME_DNS = 'application/dns-message'
+
+DNS_MESSAGE_MAX = 65535
 
 CONF_DATA_FILES = [
     FILE_FEED_JSON,
@@ -130,29 +135,6 @@ async def api_result_exc(writer, exc, code=500):
     await api_result_err(writer, fmt_exc(exc), code)
 
 
-def parse_http_raw_header(header):
-    header_str = header.decode()
-    lines = header_str.split('\r\n')
-    method = lines[0].split(' ')[0]
-
-    header_items = {}
-    for item in lines[1:]:
-        tokens = item.split(':', 1)
-        if len(tokens) == 1:
-            key, value = tokens + ['']
-        else:
-            key, value = tokens
-
-        key = key.lower()
-        new_value = header_items.get(key, '')
-        if new_value:
-            new_value += '; '
-        new_value += value.strip()
-        header_items[key] = new_value
-
-    return method.upper(), header_items
-
-
 async def web_socket_accept(headers, writer):
     websocket_key = headers.get('sec-websocket-key')
     if not websocket_key:
@@ -326,6 +308,11 @@ class ApiHandler:
         self.route('POST', '/api/user_settings', self.api_set_settings)
         self.route('POST', '/api/simple_cmd', self.api_simple_cmd)
         self.route('POST', '/api/update_rules', self.api_update_rules)
+        self.route('GET ', '/api/route_status', self.api_route_status)
+        self.route('GET ', '/api/dns_status', self.api_dns_status)
+        if DNS_SERVER_CONF['doh_endpoint']:
+            self.route('GET ', '/dns-query', self.get_dns_query)
+            self.route('POST', '/dns-query', self.post_dns_query)
 
     def route(self, method, path, func):
         method_ = method.strip().upper()
@@ -493,15 +480,57 @@ class ApiHandler:
         for name, url in APP_CONF['rules'].items():
             await download(url, name)
 
-        msg = ', '.join(msg_list) + ' (application restart required!)'
-        await req.result_ok({'msg': msg})
+        reload_time = await self.app.router.reload_rules()
+        msg = ', '.join(msg_list) + f' (rules reloaded in {reload_time:.2f}s)'
+        await req.result_ok({'msg': msg, 'reload_time': reload_time})
+
+    async def api_route_status(self, req):
+        pool = self.app.upstream_pool
+        await req.result_ok(dict(
+            self.app.router.status(),
+            workers=self.app.workers.status(),
+            upstream_pool=pool and pool.status()))
+
+    async def api_dns_status(self, req):
+        await req.result_ok({
+            'server': self.app.dns_server.status(),
+            'cache': self.app.router.dns.cache.stats(),
+        })
+
+    async def reply_dns_query(self, req, data):
+        peer_ip = req.writer.get_extra_info('peername')[0]
+        response = await self.app.dns_server.handle(data, peer_ip)
+        if response is None:
+            await api_result_err(req.writer, 'bad dns query')
+        else:
+            await write_http_response(req.writer, response, 200, MIME_DNS)
+
+    async def get_dns_query(self, req):
+        dns = parse_qs(req.url.query).get('dns', [''])[0]
+        try:
+            data = base64.urlsafe_b64decode(dns + '=' * (-len(dns) % 4))
+        except binascii.Error as exc:
+            raise HttpBadRequest(exc)
+
+        await self.reply_dns_query(req, data)
+
+    async def post_dns_query(self, req):
+        try:
+            content_length = int(req.headers['content-length'])
+            if content_length > DNS_MESSAGE_MAX:
+                raise ValueError(f'too large: {content_length}')
+            data = await req.reader.readexactly(content_length)
+        except Exception as exc:
+            raise HttpBadRequest(exc)
+
+        await self.reply_dns_query(req, data)
 
     def is_pac_path(self, path):
         url = urlsplit(path)
         return url.path == self.pac_path
 
-    async def handle(self, reader, writer, path, raw_header):
-        method, headers = parse_http_raw_header(raw_header)
+    async def handle(self, reader, writer, path, head):
+        method, headers = head.method.upper(), head.fields
         logger.debug(f'HTTP API: {method} {path}')
         url = urlsplit(path)
         api_path = url.path
@@ -545,15 +574,27 @@ class ApiHandler:
         return True
 
 
-def get_api_filter(app):
+def get_api_filter(app, forwarded=False):
+    """With `forwarded`, requests come from the workers, which name the
+    real peer in the PEER_HEADER header, and only API paths are served."""
     api_handler = ApiHandler(app)
 
     async def http_filter(reader, writer, tunnel_mode,
-                          host, port, path, raw_header):
+                          host, port, path, head):
         peer_ip_ = writer.get_extra_info('peername')[0]
+        if forwarded:
+            peer_ip_ = head.get(PEER_HEADER, peer_ip_)
+            peer_ip_ = peer_ip_.split(';')[0]  # the worker's comes first
         peer_ip = ip_address(peer_ip_)
 
         if tunnel_mode or host:
+            if forwarded:
+                # The workers proxy on their own and only pass API paths
+                # on, anything else here would make an open proxy.
+                logger.warning(f'prevent proxy request to the API port '
+                               f'from {peer_ip}')
+                await api_result_err(writer, 'not a proxy', 403)
+                return True
             if not peer_ip.is_loopback and not app.did_allow_lan:
                 logger.warning(f'prevent proxy request from {peer_ip}')
                 return True
@@ -567,7 +608,7 @@ def get_api_filter(app):
             did_allow = app.did_allow_lan or IS_DEBUG
 
         if did_allow:
-            await api_handler.handle(reader, writer, path, raw_header)
+            await api_handler.handle(reader, writer, path, head)
         else:
             msg = f'you are not allowed to access this page! ({peer_ip})'
             await api_result_err(writer, msg, 403)
@@ -1,51 +1,221 @@
-import ipaddress
+import socket
+from array import array
+from bisect import bisect_right
 
+_MASK_64 = (1 << 64) - 1
 
-class CIDRList:
-    def __init__(self, data_file):
-        self.shift_bits = 0
-        self.ip_table = {}
-        self.init_table(data_file)
 
-    def get_min_prefixlen(self, data):
-        def get_prefixlen(cidr):
-            return ipaddress.IPv4Network(cidr).prefixlen
+class Uint128Array:
+    """Compact array of 128-bit unsigned integers.
+
+    Values are kept as (high, low) pairs of 'Q' words, which is 16 bytes
+    per item instead of a list of Python ints, and still can be searched
+    with `bisect`.
+    """
+
+    def __init__(self, values=()):
+        self.words = array('Q')
+        for value in values:
+            self.append(value)
+
+    @classmethod
+    def from_words(cls, words):
+        result = cls()
+        result.words = words
+        return result
+
+    def append(self, value):
+        self.words.append(value >> 64)
+        self.words.append(value & _MASK_64)
+
+    def __len__(self):
+        return len(self.words) // 2
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+
+        words = self.words
+        return words[index * 2] << 64 | words[index * 2 + 1]
+
+
+class AddressFamily:
+    def __init__(self, name, bits):
+        self.name = name
+        self.bits = bits
+        self.max_value = (1 << bits) - 1
+
+    def to_int(self, ip_str):
+        # inet_pton, unlike inet_aton, takes no shorthand such as "10.1".
+        af = socket.AF_INET if self.bits == 32 else socket.AF_INET6
+        try:
+            packed = socket.inet_pton(af, ip_str)
+        except OSError:
+            raise ValueError(f'bad {self.name} address: {ip_str!r}')
+
+        return int.from_bytes(packed, 'big')
+
+    def parse_cidr(self, cidr):
+        ip_str, _, prefix = cidr.partition('/')
+        prefix_len = int(prefix) if prefix else self.bits
+        if prefix_len not in range(0, self.bits + 1):
+            raise ValueError(f'bad prefix length: {cidr}')
+
+        host_bits = self.bits - prefix_len
+        start = self.to_int(ip_str) >> host_bits << host_bits
+        return start, start + (1 << host_bits) - 1
+
+    def make_array(self):
+        if self.bits == 32:
+            return array('I')
+        else:
+            return Uint128Array()
+
+
+IPV4 = AddressFamily('IPv4', 32)
+IPV6 = AddressFamily('IPv6', 128)
+
+
+def family_of(ip_str):
+    return IPV6 if ':' in ip_str else IPV4
+
+
+def ipv4_to_int(ip_str):
+    return IPV4.to_int(ip_str)
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+class RangeList:
+    """Sorted, non-overlapping address ranges of one family."""
+
+    def __init__(self, family, ranges=()):
+        self.family = family
+        self.starts = family.make_array()
+        self.ends = family.make_array()
 
-        prefix_len_data = list(map(get_prefixlen, data))
-        return min(prefix_len_data)
+        for start, end in merge_ranges(ranges):
+            self.starts.append(start)
+            self.ends.append(end)
 
-    def get_table_id(self, ip_str):
-        ip_num = int(ipaddress.IPv4Address(ip_str))
-        return ip_num >> self.shift_bits
+    def __len__(self):
+        return len(self.starts)
+
+    def ranges(self):
+        return zip(self.starts, self.ends)
+
+    def contains_num(self, ip_num):
+        index = bisect_right(self.starts, ip_num) - 1
+        return index >= 0 and ip_num <= self.ends[index]
+
+
+class CIDRList:
+    def __init__(self, data_file):
+        self.tables = {}
+        self.init_table(data_file)
 
     def init_table(self, data_file):
         data = []
         with open(data_file) as file:
             data = file.readlines()
 
-        def is_ipv4_rule(ip):
-            return ':' not in ip
+        data = filter(None, map(str.strip, data))
+        ranges = {IPV4: [], IPV6: []}
+        for item in data:
+            family = family_of(item)
+            ranges[family].append(family.parse_cidr(item))
 
-        data = filter(is_ipv4_rule, data)
-        data = [line.rstrip() for line in data]
-        min_prelen = self.get_min_prefixlen(data)
-        assert min_prelen in range(1, 33)
+        for family, family_ranges in ranges.items():
+            self.tables[family] = RangeList(family, family_ranges)
 
-        self.shift_bits = 32 - min_prelen
-        for item in data:
-            ip_str = item.split('/')[0]
-            tab_id = self.get_table_id(ip_str)
-            record = ipaddress.IPv4Network(item)
-            self.ip_table.setdefault(tab_id, []).append(record)
-
-    def contains(self, ipv4):
-        tab_id = self.get_table_id(ipv4)
-        if tab_id not in self.ip_table:
-            return False
-
-        ip_addr = ipaddress.IPv4Address(ipv4)
-        for record in self.ip_table[tab_id]:
-            if ip_addr in record:
-                return True
-
-        return False
+    def __len__(self):
+        return sum(map(len, self.tables.values()))
+
+    def ranges(self, family=IPV4):
+        return self.tables[family].ranges()
+
+    def contains(self, ip):
+        family = family_of(ip)
+        return self.tables[family].contains_num(family.to_int(ip))
+
+
+class IntervalMap:
+    """Maps the whole address space of one family onto small integers.
+
+    `bounds[i]` is the first address of the i-th range and `values[i]` the
+    value of every address up to the next bound, so a lookup is one bisect.
+    """
+
+    def __init__(self, family, bounds, values):
+        self.family = family
+        self.bounds = bounds
+        self.values = values
+
+    @classmethod
+    def from_layers(cls, family, layers, default):
+        """Flatten `(RangeList, value)` pairs, earlier layers take priority."""
+        points = {0}
+        for range_list, _ in layers:
+            for start, end in range_list.ranges():
+                points.add(start)
+                if end < family.max_value:
+                    points.add(end + 1)
+
+        def value_at(ip_num):
+            for range_list, value in layers:
+                if range_list.contains_num(ip_num):
+                    return value
+            return default
+
+        bounds = family.make_array()
+        values = array('b')
+        for point in sorted(points):
+            value = value_at(point)
+            if values and values[-1] == value:
+                continue
+            bounds.append(point)
+            values.append(value)
+
+        return cls(family, bounds, values)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def lookup_num(self, ip_num):
+        return self.values[bisect_right(self.bounds, ip_num) - 1]
+
+
+class IPMap:
+    """An `IntervalMap` for each address family, built from CIDR lists."""
+
+    def __init__(self, maps):
+        self.maps = maps
+
+    @classmethod
+    def from_layers(cls, layers, default):
+        """Flatten `(CIDRList, value)` pairs, earlier layers take priority."""
+        maps = {}
+        for family in (IPV4, IPV6):
+            family_layers = [(cidr_list.tables[family], value)
+                             for cidr_list, value in layers]
+            maps[family] = IntervalMap.from_layers(
+                family, family_layers, default)
+
+        return cls(maps)
+
+    def __len__(self):
+        return sum(map(len, self.maps.values()))
+
+    def lookup(self, ip):
+        family = family_of(ip)
+        return self.maps[family].lookup_num(family.to_int(ip))
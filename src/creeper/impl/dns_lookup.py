@@ -1,159 +1,256 @@
 import asyncio
 import base64
-import ipaddress
+import random
 import socket
 import ssl
 
 import httpx
 
+from creeper.impl.dns_message import DnsMessage, DnsFormatError, \
+    QUERY_TYPES, make_query
 
-def parse_dns_string(reader, data):
-    res = ''
-    to_resue = None
-    bytes_left = 0
 
-    for ch in data:
-        if not ch:
-            break
-
-        if to_resue is not None:
-            resue_pos = chr(to_resue) + chr(ch)
-            res += reader.reuse(resue_pos)
-            break
-
-        if bytes_left:
-            res += chr(ch)
-            bytes_left -= 1
-            continue
-
-        if (ch >> 6) == 0b11 and reader is not None:
-            to_resue = ch - 0b11000000
-        else:
-            bytes_left = ch
-
-        if res:
-            res += '.'
+class DnsResolver:
+    def __init__(self, domain, qtype='A', id_=0):
+        self.domain = domain
+        self.qtype = QUERY_TYPES[qtype]
+        self.id = id_
+        self.request = make_query(domain, qtype, id_)
 
-    return res
+    def check(self, message):
+        if not message.is_response or message.id != self.id:
+            raise DnsFormatError('not a response to the query')
 
+        questions = message.questions
+        if len(questions) != 1 or questions[0].type != self.qtype or \
+                questions[0].name.lower() != self.domain.lower():
+            raise DnsFormatError('question mismatch')
 
-class StreamReader:
-    def __init__(self, data):
-        self.data = data
-        self.pos = 0
+    def parse(self, data):
+        message = DnsMessage(data)
+        self.check(message)
+        return message.to_result()
 
-    def read(self, len_):
-        pos = self.pos
-        if pos >= len(self.data):
-            raise
 
-        res = self.data[pos: pos+len_]
-        self.pos += len_
-        return res
+def dns_lookup(domain, address, timeout_sec=0.2, qtype='A'):
+    # Blocking, for use outside of the event loop. See `UdpDnsClient`.
+    resolver = DnsResolver(domain, qtype, random.getrandbits(16))
+    req = resolver.request
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout_sec)
 
-    def reuse(self, pos):
-        pos = int.from_bytes(pos.encode(), 'big')
-        return parse_dns_string(None, self.data[pos:])
+    try:
+        sock.sendto(req, (address, 53))
+        res, _ = sock.recvfrom(1024 * 4)
+        return resolver.parse(res)
+    except Exception:
+        pass
+    finally:
+        sock.close()
 
 
-def make_dns_query_domain(domain):
-    def f(s):
-        return chr(len(s)) + s
+def split_server(server, default_port=53):
+    # "1.2.3.4", "1.2.3.4:53", "::1" or "[::1]:53"
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']:')
+        return host.rstrip(']'), int(port or default_port)
 
-    parts = domain.split('.')
-    parts = list(map(f, parts))
-    return ''.join(parts).encode()
+    if server.count(':') == 1:
+        host, port = server.split(':')
+        return host, int(port)
 
+    return server, default_port
 
-def make_dns_request_data(dns_query):
-    req = b'\xaa\xbb\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
-    req += dns_query
-    req += b'\x00\x00\x01\x00\x01'
-    return req
 
+class UdpDnsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
 
-def add_record_to_result(result, type_, data, reader):
-    if type_ == 'A':
-        item = str(ipaddress.IPv4Address(data))
-    elif type_ == 'CNAME':
-        item = parse_dns_string(reader, data)
-    else:
-        return
+    def datagram_received(self, data, addr):
+        self.client.on_datagram(data)
 
-    result.setdefault(type_, []).append(item)
+    def error_received(self, exc):
+        self.client.fail_pending(exc)
 
+    def connection_lost(self, exc):
+        self.client.transport = None
+        self.client.fail_pending(exc or ConnectionError('endpoint closed'))
 
-def parse_dns_response(res, dq_len, req):
-    reader = StreamReader(res)
 
-    def get_query(s):
-        return s[12:12+dq_len]
+class UdpDnsClient:
+    """Plain DNS over UDP for one server, usable from the event loop.
 
-    data = reader.read(len(req))
-    assert get_query(data) == get_query(req)
+    Queries share one datagram endpoint and are told apart by a random
+    transaction id, at most `max_inflight` of them are on the wire at
+    once. A truncated answer is asked again over TCP.
+    """
 
-    def to_int(bytes_):
-        return int.from_bytes(bytes_, 'big')
+    def __init__(self, server, max_inflight=64):
+        self.server = server
+        self.address = split_server(server)
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.transport = None
+        self.connecting = None
+        self.pending = {}  # transaction id => (resolver, future)
 
-    result = {}
-    res_num = to_int(data[6:8])
-    for i in range(res_num):
-        reader.read(2)
-        type_num = to_int(reader.read(2))
+    async def get_transport(self):
+        if self.transport is None:
+            if self.connecting is None:
+                loop = asyncio.get_running_loop()
+                self.connecting = asyncio.ensure_future(
+                    loop.create_datagram_endpoint(
+                        lambda: UdpDnsProtocol(self),
+                        remote_addr=self.address))
+            try:
+                self.transport, _ = await asyncio.shield(self.connecting)
+            finally:
+                self.connecting = None
 
-        type_ = None
-        if type_num == 1:
-            type_ = 'A'
-        elif type_num == 5:
-            type_ = 'CNAME'
+        return self.transport
 
-        reader.read(6)
-        data = reader.read(2)
-        data = reader.read(to_int(data))
-        add_record_to_result(result, type_, data, reader)
+    def on_datagram(self, data):
+        try:
+            message = DnsMessage(data)
+            resolver, future = self.pending[message.id]
+            resolver.check(message)
+        except (DnsFormatError, KeyError):
+            return  # late, spoofed or broken: keep waiting
+
+        if not future.done():
+            future.set_result(message)
+
+    def fail_pending(self, exc):
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def new_id(self):
+        while True:
+            id_ = random.getrandbits(16)
+            if id_ not in self.pending:
+                return id_
+
+    async def query(self, domain, qtype='A', timeout_sec=2.0):
+        async with self.semaphore:
+            transport = await self.get_transport()
+            resolver = DnsResolver(domain, qtype, self.new_id())
+            future = asyncio.get_running_loop().create_future()
+            self.pending[resolver.id] = (resolver, future)
+            try:
+                transport.sendto(resolver.request)
+                message = await asyncio.wait_for(future, timeout_sec)
+            finally:
+                del self.pending[resolver.id]
+
+        if message.is_truncated:
+            return await asyncio.wait_for(
+                self.query_tcp(resolver), timeout_sec)
+
+        return message.to_result()
+
+    async def query_tcp(self, resolver):
+        reader, writer = await asyncio.open_connection(*self.address)
+        try:
+            request = resolver.request
+            writer.write(len(request).to_bytes(2, 'big') + request)
+            size = int.from_bytes(await reader.readexactly(2), 'big')
+            return resolver.parse(await reader.readexactly(size))
+        finally:
+            writer.close()
 
-    return result
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
 
 
-class DnsResolver:
-    def __init__(self, domain):
-        dns_query = make_dns_query_domain(domain)
-        self.dq_len = len(dns_query)
-        self.request = make_dns_request_data(dns_query)
+_udp_clients = {}
 
-    def parse(self, data):
-        return parse_dns_response(data, self.dq_len, self.request)
 
+def get_udp_client(server):
+    client = _udp_clients.get(server)
+    if client is None:
+        client = UdpDnsClient(server)
+        _udp_clients[server] = client
+    return client
 
-def dns_lookup(domain, address, timeout_sec=0.2):
-    resolver = DnsResolver(domain)
-    req = resolver.request
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(timeout_sec)
 
+def _has_http2():
     try:
-        sock.sendto(req, (address, 53))
-        res, _ = sock.recvfrom(1024 * 4)
-        return resolver.parse(res)
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+HTTP2_ENABLED = _has_http2()
+_ssl_context = None
+_doh_clients = {}
+
+
+def get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class DohClient:
+    """A long-lived DoH client for one server.
+
+    Connections are kept alive between queries. With HTTP/2 (when `h2` is
+    available) concurrent queries are multiplexed over a single connection,
+    otherwise they share a small pool of HTTP/1.1 connections.
+    """
+
+    def __init__(self, server, proxy=None):
+        self.server = server
+        limits = httpx.Limits(
+            max_connections=8,
+            max_keepalive_connections=4,
+            keepalive_expiry=120)
+        self.session = httpx.AsyncClient(
+            verify=get_ssl_context(), proxy=proxy,
+            http2=HTTP2_ENABLED, limits=limits)
+
+    async def query(self, domain, qtype='A', timeout_sec=10.0):
+        resolver = DnsResolver(domain, qtype)
+        dns = base64.urlsafe_b64encode(resolver.request) \
+            .decode().rstrip('=')
+        url = f'https://{self.server}/dns-query?dns={dns}'
+        headers = {'accept': 'application/dns-message'}
+        reply = await self.session.get(
+            url, headers=headers, timeout=timeout_sec)
+        return resolver.parse(reply.content)
+
+    async def close(self):
+        await self.session.aclose()
+
+
+def get_doh_client(server, proxy=None):
+    key = (server, proxy)
+    client = _doh_clients.get(key)
+    if client is None:
+        client = DohClient(server, proxy)
+        _doh_clients[key] = client
+    return client
+
+
+async def close_dns_clients():
+    clients = [*_doh_clients.values(), *_udp_clients.values()]
+    _doh_clients.clear()
+    _udp_clients.clear()
+    for client in clients:
+        await client.close()
+
+
+async def doh_lookup(domain, server, proxy=None, timeout_sec=10.0,
+                     qtype='A'):
+    client = get_doh_client(server, proxy)
+    try:
+        return await client.query(domain, qtype, timeout_sec)
     except Exception:
         pass
-    finally:
-        sock.close()
-
-
-async def doh_lookup(domain, server, proxy=None, timeout_sec=10.0):
-    resolver = DnsResolver(domain)
-    dns = base64.urlsafe_b64encode(resolver.request) \
-        .decode().rstrip('=')
-    url = f'https://{server}/dns-query?dns={dns}'
-    ctx = ssl.create_default_context()
-
-    async with httpx.AsyncClient(verify=ctx, proxy=proxy) as session:
-        try:
-            reply = await session.get(url, timeout=timeout_sec)
-            return resolver.parse(reply.content)
-        except Exception:
-            pass
 
 
 if __name__ == '__main__':
@@ -162,5 +259,6 @@ if __name__ == '__main__':
     async def test_doh():
         print(await doh_lookup(
             'www.google.com', '8.8.8.8', 'http://127.0.0.1:1080'))
+        await close_dns_clients()
 
     asyncio.run(test_doh())
@@ -0,0 +1,291 @@
+import socket
+import struct
+from typing import NamedTuple
+
+QUERY_TYPES = {
+    'A': 1,
+    'CNAME': 5,
+    'AAAA': 28,
+}
+
+TYPE_NAMES = {num: name for name, num in QUERY_TYPES.items()}
+
+CLASS_IN = 1
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+HEADER = struct.Struct('!6H')  # id, flags, qd, an, ns, ar counts
+QUESTION_TAIL = struct.Struct('!2H')  # type, class
+RECORD_TAIL = struct.Struct('!2HIH')  # type, class, TTL, data length
+POINTER_RECORD = struct.Struct('!3HIH')  # name pointer, record tail
+
+MAX_NAME_LEN = 255
+MAX_LABEL_LEN = 63
+POINTER_MARK = 0xc0
+
+ADDRESS_FAMILIES = {
+    QUERY_TYPES['A']: (socket.AF_INET, 4),
+    QUERY_TYPES['AAAA']: (socket.AF_INET6, 16),
+}
+
+
+class DnsFormatError(ValueError):
+    pass
+
+
+class Question(NamedTuple):
+    name: str
+    type: int
+    klass: int
+
+
+class Record(NamedTuple):
+    name: str
+    type: int
+    klass: int
+    ttl: int
+    offset: int  # of the record data in the message
+    data: memoryview
+
+
+def read_name(view, offset, names=None):
+    """Decode the name at `offset`, return it with the offset after it.
+
+    Compression pointers may be nested, but each one has to point before
+    the labels it was reached from, so a malformed message can not loop.
+    `names` maps offsets to names decoded before, so a pointer to one of
+    them is resolved at once.
+    """
+    start = offset
+    labels = []
+    wire_len = 1
+    end = None
+    limit = offset
+    suffix = None
+    while True:
+        if offset >= len(view):
+            raise DnsFormatError('name out of range')
+
+        size = view[offset]
+        if size >= POINTER_MARK:
+            if offset + 1 >= len(view):
+                raise DnsFormatError('pointer out of range')
+            target = (size & 0x3f) << 8 | view[offset + 1]
+            if target >= limit:
+                raise DnsFormatError('pointer does not point backward')
+            if end is None:
+                end = offset + 2
+            if names is not None and target in names:
+                suffix = names[target]
+                break
+            offset = limit = target
+            continue
+
+        if size > MAX_LABEL_LEN:
+            raise DnsFormatError('bad label length')
+
+        offset += 1
+        if not size:
+            break
+
+        wire_len += size + 1
+        if wire_len > MAX_NAME_LEN:
+            raise DnsFormatError('name too long')
+        if offset + size > len(view):
+            raise DnsFormatError('label out of range')
+        labels.append(view[offset:offset + size])
+        offset += size
+
+    if end is None:
+        end = offset
+
+    name = b'.'.join(labels).decode('latin-1')
+    if suffix:
+        name = f'{name}.{suffix}' if name else suffix
+        if len(name) + 2 > MAX_NAME_LEN:
+            raise DnsFormatError('name too long')
+    if names is not None:
+        names[start] = name
+    return name, end
+
+
+class DnsMessage:
+    """A parsed DNS message with its question and answer sections.
+
+    Records keep their data as slices of the original buffer, values are
+    decoded only when asked for.
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        try:
+            self.parse()
+        except struct.error as e:
+            raise DnsFormatError(f'truncated: {e}') from None
+
+    def parse(self):
+        view = self.view
+        names = self.names = {}
+        self.id, self.flags, qd_count, an_count, _, _ = \
+            HEADER.unpack_from(view)
+        offset = HEADER.size
+
+        self.questions = []
+        for _ in range(qd_count):
+            name, offset = read_name(view, offset, names)
+            qtype, klass = QUESTION_TAIL.unpack_from(view, offset)
+            offset += QUESTION_TAIL.size
+            self.questions.append(Question(name, qtype, klass))
+
+        self.answers = []
+        for _ in range(an_count):
+            # Fast path: the owner is a pointer to a name seen before.
+            if len(view) >= offset + POINTER_RECORD.size:
+                word, rtype, klass, ttl, length = \
+                    POINTER_RECORD.unpack_from(view, offset)
+                is_pointer = word >> 8 >= POINTER_MARK
+                name = names.get(word & 0x3fff) if is_pointer else None
+            else:
+                name = None
+
+            if name is not None:
+                offset += POINTER_RECORD.size
+            else:
+                name, offset = read_name(view, offset, names)
+                rtype, klass, ttl, length = \
+                    RECORD_TAIL.unpack_from(view, offset)
+                offset += RECORD_TAIL.size
+
+            if offset + length > len(view):
+                raise DnsFormatError('record data out of range')
+            data = view[offset:offset + length]
+            self.answers.append(Record(name, rtype, klass, ttl, offset, data))
+            offset += length
+
+    @property
+    def is_response(self):
+        return bool(self.flags & FLAG_QR)
+
+    @property
+    def is_truncated(self):
+        return bool(self.flags & FLAG_TC)
+
+    @property
+    def opcode(self):
+        return self.flags >> 11 & 0xf
+
+    @property
+    def rcode(self):
+        return self.flags & 0xf
+
+    def value(self, record):
+        """IP address for A/AAAA, target name for CNAME, else None."""
+        if record.type in ADDRESS_FAMILIES:
+            family, size = ADDRESS_FAMILIES[record.type]
+            if len(record.data) != size:
+                raise DnsFormatError('bad address length')
+            return socket.inet_ntop(family, record.data)
+
+        if record.type == QUERY_TYPES['CNAME']:
+            return read_name(self.view, record.offset, self.names)[0]
+
+    def to_result(self):
+        # {'A': [...], 'CNAME': [...], 'ttl': min TTL of those records}
+        result = {}
+        for record in self.answers:
+            type_ = TYPE_NAMES.get(record.type)
+            if type_ is None:
+                continue
+
+            result.setdefault(type_, []).append(self.value(record))
+            result['ttl'] = min(record.ttl, result.get('ttl', record.ttl))
+
+        return result
+
+
+class MessageWriter:
+    """Builds a DNS message, repeated name suffixes become pointers."""
+
+    def __init__(self):
+        self.buffer = bytearray(HEADER.size)
+        self.name_offsets = {}
+        self.counts = [0, 0]  # questions, answers
+
+    def write_name(self, name):
+        labels = [i.encode() for i in name.rstrip('.').split('.') if i]
+        if sum(len(i) + 1 for i in labels) + 1 > MAX_NAME_LEN:
+            raise ValueError(f'domain name too long: {name}')
+
+        buffer = self.buffer
+        for index, label in enumerate(labels):
+            suffix = b'.'.join(labels[index:]).lower()
+            offset = self.name_offsets.get(suffix)
+            if offset is not None:
+                buffer += (POINTER_MARK << 8 | offset).to_bytes(2, 'big')
+                return
+
+            if len(label) > MAX_LABEL_LEN:
+                raise ValueError(f'bad domain name: {name}')
+            if len(buffer) < 0x4000:  # reachable by a pointer
+                self.name_offsets[suffix] = len(buffer)
+            buffer.append(len(label))
+            buffer += label
+
+        buffer.append(0)
+
+    def add_question(self, name, qtype, klass=CLASS_IN):
+        self.write_name(name)
+        self.buffer += QUESTION_TAIL.pack(qtype, klass)
+        self.counts[0] += 1
+
+    def add_record(self, name, rtype, ttl, value, klass=CLASS_IN):
+        """`value` is an IP address for A/AAAA, a name for CNAME."""
+        self.write_name(name)
+        offset = len(self.buffer)
+        self.buffer += RECORD_TAIL.pack(rtype, klass, ttl, 0)
+        begin = len(self.buffer)
+        if rtype in ADDRESS_FAMILIES:
+            self.buffer += socket.inet_pton(ADDRESS_FAMILIES[rtype][0], value)
+        elif rtype == QUERY_TYPES['CNAME']:
+            self.write_name(value)
+        else:
+            self.buffer += value
+
+        length = len(self.buffer) - begin
+        RECORD_TAIL.pack_into(self.buffer, offset, rtype, klass, ttl, length)
+        self.counts[1] += 1
+
+    def to_bytes(self, id_, flags):
+        HEADER.pack_into(self.buffer, 0, id_, flags, *self.counts, 0, 0)
+        return bytes(self.buffer)
+
+
+def make_query(name, qtype='A', id_=0):
+    writer = MessageWriter()
+    writer.add_question(name, QUERY_TYPES[qtype])
+    return writer.to_bytes(id_, FLAG_RD)
+
+
+def make_response(query, records=(), rcode=RCODE_NOERROR, truncated=False):
+    """Reply to `query` with `(name, type, TTL, value)` answer records."""
+    writer = MessageWriter()
+    for question in query.questions:
+        writer.add_question(*question)
+    if not truncated:
+        for name, rtype, ttl, value in records:
+            writer.add_record(name, rtype, ttl, value)
+
+    flags = FLAG_QR | FLAG_RA | query.flags & FLAG_RD | rcode
+    if truncated:
+        flags |= FLAG_TC
+    return writer.to_bytes(query.id, flags)
@@ -0,0 +1,68 @@
+import socket
+from collections import OrderedDict
+from ipaddress import IPv4Network
+
+from creeper.impl.cidr_list import ipv4_to_int
+
+
+class FakeIPPool:
+    """Hands out addresses of a reserved IPv4 range to domain names.
+
+    The table works both ways and is bounded: past `max_len` the least
+    recently used domain loses its address. Addresses are handed out round
+    robin over the whole range, so a freed one is reused only after the
+    rest of the range, which should be well above `max_len`.
+    """
+
+    def __init__(self, network='198.18.0.0/15', max_len=65536):
+        network = IPv4Network(network)
+        self.first = int(network.network_address) + 1
+        self.size = network.num_addresses - 2  # no network/broadcast
+        self.max_len = min(max_len, self.size)
+        self.cursor = 0
+        self.domains = OrderedDict()  # domain => IP number
+        self.ips = {}  # IP number => domain
+
+    def __len__(self):
+        return len(self.domains)
+
+    def lookup(self, ip):
+        """The domain behind a fake IP, None for any other host."""
+        try:
+            ip_num = ipv4_to_int(ip)
+        except ValueError:
+            return
+
+        domain = self.ips.get(ip_num)
+        if domain is not None:
+            self.domains.move_to_end(domain)
+        return domain
+
+    def assign(self, domain):
+        ip_num = self.domains.get(domain)
+        if ip_num is not None:
+            self.domains.move_to_end(domain)
+            return self.to_str(ip_num)
+
+        if len(self.domains) >= self.max_len:
+            _, old_num = self.domains.popitem(last=False)
+            del self.ips[old_num]
+
+        ip_num = self.next_free()
+        self.domains[domain] = ip_num
+        self.ips[ip_num] = domain
+        return self.to_str(ip_num)
+
+    def next_free(self):
+        while True:
+            ip_num = self.first + self.cursor
+            self.cursor = (self.cursor + 1) % self.size
+            if ip_num not in self.ips:
+                return ip_num
+
+    @staticmethod
+    def to_str(ip_num):
+        return socket.inet_ntoa(ip_num.to_bytes(4, 'big'))
+
+    def status(self):
+        return {'size': len(self.domains), 'max_len': self.max_len}
@@ -0,0 +1,60 @@
+import asyncio
+from itertools import chain, zip_longest
+
+CONNECT_DELAY = 0.25  # RFC 8305 "Connection Attempt Delay"
+
+
+def interleave(addrs):
+    # IPv6 first, then alternating families.
+    ipv6 = [i for i in addrs if ':' in i]
+    ipv4 = [i for i in addrs if ':' not in i]
+    pairs = zip_longest(ipv6, ipv4)
+    return [i for i in chain.from_iterable(pairs) if i is not None]
+
+
+def close_connection(task):
+    if not task.cancelled() and task.exception() is None:
+        _, writer = task.result()
+        writer.close()
+
+
+async def open_connection(addrs, port, delay=CONNECT_DELAY):
+    """`asyncio.open_connection` to the first of `addrs` that answers.
+
+    The next address is tried when an attempt fails, or is still pending
+    after `delay`. The first connection wins, the others are dropped.
+    """
+    addrs = interleave(addrs)
+    if len(addrs) == 1:
+        return await asyncio.open_connection(addrs[0], port)
+
+    pending = set()
+    errors = []
+    winner = None
+    try:
+        while addrs or pending:
+            if addrs:
+                pending.add(asyncio.ensure_future(
+                    asyncio.open_connection(addrs.pop(0), port)))
+
+            timeout = delay if addrs else None
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    close_connection(task)
+
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(close_connection)
+
+    raise errors[0] if errors else OSError('no address to connect')
@@ -0,0 +1,303 @@
+import asyncio
+
+from creeper.log import logger
+from creeper.utils import readable_exc
+from creeper.impl.http_head import read_http_head, HttpResponseHead, \
+    HttpHeadError
+
+BODY_CHUNK = 1024 * 64
+CHUNKED = 'chunked'
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+UNTIL_EOF = None  # a response without length, it ends the connection
+
+# Requests that can go again on a new connection when a pooled one turns
+# out closed (RFC 9110, 9.2.2).
+IDEMPOTENT_METHODS = frozenset(
+    ['GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'])
+
+
+class UpstreamClosed(ConnectionError):
+    pass
+
+
+class BadRequestBody(HttpHeadError):
+    pass
+
+
+class UpstreamPool:
+    """Idle upstream connections of the forward proxy.
+
+    They are keyed by (route, host, port): a connection is reused only for
+    the same destination reached the same way. Idle ones are closed after
+    `idle_timeout`, and skipped when the upstream has closed them.
+    """
+
+    def __init__(self, max_per_key=4, max_idle=128, idle_timeout=30):
+        self.max_per_key = max_per_key
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # key => [[connection, timer], ...]
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, key):
+        entries = self.idle.get(key, [])
+        while entries:
+            connection, timer = entries.pop()
+            self.count -= 1
+            timer.cancel()
+            reader, writer, _ = connection
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+
+            if not entries:
+                del self.idle[key]
+            self.hits += 1
+            return connection
+
+        self.idle.pop(key, None)
+        self.misses += 1
+
+    def give(self, key, connection):
+        _, writer, _ = connection
+        if writer.is_closing() or self.count >= self.max_idle or \
+                len(self.idle.get(key, ())) >= self.max_per_key:
+            writer.close()
+            return
+
+        entry = [connection, None]
+        entry[1] = asyncio.get_running_loop().call_later(
+            self.idle_timeout, self.expire, key, entry)
+        self.idle.setdefault(key, []).append(entry)
+        self.count += 1
+
+    def expire(self, key, entry):
+        entries = self.idle.get(key, [])
+        if entry in entries:
+            entries.remove(entry)
+            self.count -= 1
+            if not entries:
+                del self.idle[key]
+            entry[0][1].close()
+
+    def close(self):
+        for entries in self.idle.values():
+            for (_, writer, _), timer in entries:
+                timer.cancel()
+                writer.close()
+        self.idle.clear()
+        self.count = 0
+
+    def status(self):
+        return {'idle': self.count, 'hits': self.hits, 'misses': self.misses}
+
+
+async def copy_exact(reader, writer, size, count):
+    while size > 0:
+        data = await reader.read(min(size, BODY_CHUNK))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        writer.write(data)
+        count(len(data))
+        size -= len(data)
+        await writer.drain()
+
+
+async def read_chunk_line(reader):
+    try:
+        return await reader.readuntil(b'\r\n')
+    except asyncio.LimitOverrunError:
+        raise HttpHeadError('chunk line too long')
+
+
+def parse_chunk_size(line):
+    size = line[:-2].split(b';', 1)[0].strip(b' \t')
+    # int() would also take signs, "0x" and underscores.
+    if not size or size.translate(None, HEX_DIGITS):
+        raise HttpHeadError(f'bad chunk size: {line[:80]!r}')
+    return int(size, 16)
+
+
+async def copy_chunked(reader, writer, count):
+    # The chunks go on as they are, only their sizes are read.
+    while True:
+        line = await read_chunk_line(reader)
+        size = parse_chunk_size(line)
+        writer.write(line)
+        count(len(line))
+        if size == 0:
+            break
+        await copy_exact(reader, writer, size + 2, count)  # with CRLF
+
+    while True:  # trailer fields, up to the empty line
+        line = await read_chunk_line(reader)
+        writer.write(line)
+        count(len(line))
+        if line == b'\r\n':
+            break
+    await writer.drain()
+
+
+async def copy_until_eof(reader, writer, count):
+    while data := await reader.read(BODY_CHUNK):
+        writer.write(data)
+        count(len(data))
+        await writer.drain()
+
+
+async def copy_body(reader, writer, framing, count):
+    if framing == CHUNKED:
+        await copy_chunked(reader, writer, count)
+    elif framing is UNTIL_EOF:
+        await copy_until_eof(reader, writer, count)
+    elif framing:
+        await copy_exact(reader, writer, framing, count)
+
+
+def request_framing(head):
+    # Only chunked, the last coding, tells where a request body ends: any
+    # other is rejected (RFC 9112, 6.3), and Content-Length is then ignored.
+    if head.get('transfer-encoding') is not None:
+        if not head.is_chunked():
+            raise HttpHeadError('bad transfer coding')
+        return CHUNKED
+    return head.content_length() or 0
+
+
+def response_framing(head, response):
+    if head.method == 'HEAD' or response.status in (204, 304):
+        return 0
+    if response.status == 101:
+        return UNTIL_EOF
+    if response.is_chunked():
+        return CHUNKED
+
+    length = response.content_length()
+    return UNTIL_EOF if length is None else length
+
+
+async def reply_error(writer, status, reason):
+    writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n'
+                 'Connection: close\r\n\r\n'.encode())
+    await writer.drain()
+
+
+async def exchange(reader, writer, head, connection, reused):
+    """Sends one request upstream and relays its response.
+
+    Returns whether the client and the upstream connections can carry
+    another request. A reused connection found closed before any answer
+    raises UpstreamClosed: the request can go again on a new one. A
+    request body that is cut short or badly framed raises BadRequestBody.
+    """
+    peer_reader, peer_writer, statistic = connection
+    framing = request_framing(head)
+    strip = head.hop_by_hop() - {'transfer-encoding'}
+    if framing == CHUNKED:
+        # Both may be sent to smuggle a request past the upstream.
+        strip |= {'content-length'}
+    data = head.to_bytes(strip, [('Connection', 'keep-alive')])
+
+    try:
+        peer_writer.write(data)
+        statistic(True, len(data))
+        try:
+            await copy_body(reader, peer_writer, framing,
+                            lambda size: statistic(True, size))
+        except (HttpHeadError, EOFError) as e:
+            raise BadRequestBody(e)
+
+        while True:
+            response = await read_http_head(
+                peer_reader, head_type=HttpResponseHead)
+            if response is None:
+                raise ConnectionError('no response')
+            if not 100 <= response.status < 200 or response.status == 101:
+                break
+
+            # Interim responses ("100 Continue") go on as they are.
+            data = response.to_bytes()
+            writer.write(data)
+            statistic(False, len(data))
+    except ConnectionError as e:
+        if reused:
+            raise UpstreamClosed(e)
+        raise
+
+    framing = response_framing(head, response)
+    keep_client = head.keep_alive() and framing is not UNTIL_EOF
+    keep_upstream = response.keep_alive() and framing is not UNTIL_EOF
+
+    data = response.to_bytes(
+        response.hop_by_hop() - {'transfer-encoding'},
+        [('Connection', 'keep-alive' if keep_client else 'close')])
+    writer.write(data)
+    statistic(False, len(data))
+    try:
+        await copy_body(peer_reader, writer, framing,
+                        lambda size: statistic(False, size))
+    except (HttpHeadError, EOFError) as e:
+        # The status line is out already: the client sees the connection
+        # close before the end of the body.
+        logger.debug(f'response body: {readable_exc(e)}')
+        return False, False
+
+    return keep_client, keep_upstream
+
+
+async def forward_request(reader, writer, head, key, connect, pool):
+    """Forwards one request, True if the client connection stays open.
+
+    Idempotent requests without a body may take an idle connection of
+    `pool`, and are sent again on a new one if it turns out closed. The
+    others always go on a new connection. `connect()` opens one:
+    ((reader, writer), statistic), None on failure.
+    """
+    try:
+        has_body = request_framing(head) != 0
+    except HttpHeadError:
+        await reply_error(writer, 400, 'Bad Request')
+        return False
+
+    reusable = not has_body and head.method in IDEMPOTENT_METHODS
+    for retry in (False, True):
+        connection = pool.take(key) if reusable and not retry else None
+        reused = connection is not None
+        if connection is None:
+            try:
+                result = await connect()
+            except Exception as e:
+                logger.debug(f'connect: {readable_exc(e)}')
+                result = None
+            if result is None:
+                await reply_error(writer, 502, 'Bad Gateway')
+                return False
+            (peer_reader, peer_writer), statistic = result
+            connection = peer_reader, peer_writer, statistic
+
+        try:
+            keep_client, keep_upstream = await exchange(
+                reader, writer, head, connection, reused)
+        except UpstreamClosed:
+            connection[1].close()
+            continue
+        except BadRequestBody as e:
+            logger.debug(f'request body: {readable_exc(e)}')
+            connection[1].close()
+            await reply_error(writer, 400, 'Bad Request')
+            return False
+        except HttpHeadError:
+            connection[1].close()
+            await reply_error(writer, 502, 'Bad Gateway')
+            return False
+        except BaseException:
+            connection[1].close()
+            raise
+
+        if keep_upstream:
+            pool.give(key, connection)
+        else:
+            connection[1].close()
+        return keep_client
@@ -0,0 +1,165 @@
+import asyncio
+
+HEAD_END = b'\r\n\r\n'
+HEAD_LIMIT = 1024 * 64
+
+HOP_BY_HOP = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+])
+
+
+class HttpHeadError(ValueError):
+    pass
+
+
+def parse_head_lines(data):
+    """(start line, [(name, value), ...]) of a head ending with CRLF CRLF."""
+    if len(data) > HEAD_LIMIT:
+        raise HttpHeadError('head too large')
+
+    lines = data.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name:
+            raise HttpHeadError(f'bad header line: {line[:80]!r}')
+        headers.append((name, value.strip()))
+
+    return lines[0], headers
+
+
+def split_tokens(value):
+    tokens = value.replace(';', ',').split(',')
+    return {i.strip().lower() for i in tokens} - {''}
+
+
+class HttpHead:
+    """A request head, parsed once for the proxy and the API.
+
+    `headers` holds the fields as received, in order. `fields` maps the
+    lower-cased names to their values, repeated fields joined by "; ".
+    The head is decoded as latin-1, so it is written back byte for byte.
+    """
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.set_headers(headers)
+
+    def set_headers(self, headers):
+        self.headers = headers
+        self.fields = {}
+        for name, value in headers:
+            key = name.lower()
+            joined = self.fields.get(key)
+            self.fields[key] = value if not joined else f'{joined}; {value}'
+
+    @classmethod
+    def parse(cls, data):
+        start_line, headers = parse_head_lines(data)
+        request_line = start_line.split(' ')
+        if len(request_line) != 3:
+            raise HttpHeadError(f'bad request line: {start_line[:80]!r}')
+
+        return cls(*request_line, headers)
+
+    def get(self, name, default=None):
+        return self.fields.get(name.lower(), default)
+
+    def connection_tokens(self):
+        # Old clients still say "Proxy-Connection" to proxies.
+        return split_tokens(self.get('connection', '')) | \
+            split_tokens(self.get('proxy-connection', ''))
+
+    def hop_by_hop(self):
+        """The standard hop-by-hop names, and those named by Connection."""
+        return HOP_BY_HOP.union(self.connection_tokens())
+
+    def keep_alive(self):
+        tokens = self.connection_tokens()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+    def is_chunked(self):
+        codings = self.get('transfer-encoding', '').split(',')
+        return codings[-1].strip().lower() == 'chunked'
+
+    def content_length(self):
+        """The Content-Length, None without one."""
+        value = self.get('content-length')
+        if value is None:
+            return
+
+        # Repeated fields must agree.
+        values = split_tokens(value)
+        if len(values) != 1 or not all(i.isdigit() for i in values):
+            raise HttpHeadError(f'bad content length: {value[:80]!r}')
+        return int(values.pop())
+
+    def start_line(self):
+        return f'{self.method} {self.target} {self.version}'
+
+    def to_bytes(self, strip=(), extra=()):
+        """The head to send on, without the `strip` fields (lower-cased
+        names) and with the `extra` ones first."""
+        lines = [self.start_line()]
+        lines += [f'{name}: {value}' for name, value in extra]
+        lines += [f'{name}: {value}' for name, value in self.headers
+                  if name.lower() not in strip]
+        lines += ['', '']
+        return '\r\n'.join(lines).encode('latin-1')
+
+
+class HttpResponseHead(HttpHead):
+    """A response head, as read from an upstream server."""
+
+    def __init__(self, version, status, reason, headers):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.set_headers(headers)
+
+    @classmethod
+    def parse(cls, data):
+        start_line, headers = parse_head_lines(data)
+        status_line = start_line.split(' ', 2)
+        if len(status_line) < 2 or not status_line[1].isdigit() or \
+                not status_line[0].startswith('HTTP/'):
+            raise HttpHeadError(f'bad status line: {start_line[:80]!r}')
+
+        version, status = status_line[:2]
+        reason = status_line[2] if len(status_line) == 3 else ''
+        return cls(version, int(status), reason, headers)
+
+    def connection_tokens(self):
+        return split_tokens(self.get('connection', ''))
+
+    def start_line(self):
+        return f'{self.version} {self.status} {self.reason}'
+
+
+async def read_http_head(reader, prefix=b'', head_type=HttpHead):
+    """Reads and parses a head, None on EOF before its end.
+
+    `prefix` is what was already read of the head.
+    """
+    try:
+        data = await reader.readuntil(HEAD_END)
+    except asyncio.IncompleteReadError:
+        return
+    except asyncio.LimitOverrunError:
+        raise HttpHeadError('head too large')
+
+    return head_type.parse(prefix + data)
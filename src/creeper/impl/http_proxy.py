@@ -8,10 +8,15 @@ from creeper.log import logger
 from creeper.utils import readable_exc
 from creeper.impl.socks5 import \
     try_negotiate_socks5, end_negotiate_socks5
+from creeper.impl.socket_relay import relay_detached, SPLICE_ENABLED
+from creeper.impl.transport_pipe import pipe_streams
+from creeper.impl.http_head import read_http_head, HttpHeadError, \
+    HOP_BY_HOP
+from creeper.impl.http_forward import forward_request
 
 
-all_clients = {}
 REQUEST_URI_PARSER = re.compile(r'(.+)\:(\d+)$')
+KEEP_ALIVE_TIMEOUT = 60  # for the next request of a client
 
 
 def split_host_port(loc):
@@ -35,25 +40,25 @@ def parse_request_uri(uri):
     return split_host_port(uri_result.netloc), path
 
 
-async def read_http_header(reader):
-    header = b''
-    while True:
-        line = await reader.readline()
-        if not line:
-            break
-
-        header += line
-        if line == b'\r\n':
-            break
+# The body and any later request on the connection are relayed as they
+# are, so the fields framing them (and upgrades) stay.
+RELAY_STRIP = HOP_BY_HOP - {'connection', 'transfer-encoding', 'upgrade'}
 
-    return header
 
+def get_request_info(head):
+    tunnel_mode = (head.method == 'CONNECT')
+    if tunnel_mode:
+        host, port = split_host_port(head.target)
+        path = None
+        if not port:
+            return
+    else:
+        (host, port), path = parse_request_uri(head.target)
+        if not port:
+            port = 80
+        head.target = path
 
-def remore_useless_header(header):
-    def not_proxy_keep_alive(x):
-        return not x.lower().startswith('proxy-connection:')
-
-    return list(filter(not_proxy_keep_alive, header))
+    return head, tunnel_mode, host, port, path
 
 
 async def get_request_info_from_header(reader, writer):
@@ -61,47 +66,54 @@ async def get_request_info_from_header(reader, writer):
     if did_return:
         return result
 
-    header = await read_http_header(reader)
-    if not header:
+    try:
+        head = await read_http_head(reader, result)
+    except HttpHeadError as e:
+        logger.debug(f'bad header: {e}')
+        return
+
+    if head is None:
         logger.debug('failed to read header')
         return
 
-    header = result + header
-    header_items = header.decode().split('\r\n')
-    method_args = header_items[0].split(' ')
-    method = method_args[0]
-    uri = method_args[1]
-    tunnel_mode = (method == 'CONNECT')
+    return get_request_info(head)
 
-    if tunnel_mode:
-        host, port = split_host_port(uri)
-        path = None
-        if not port:
-            return
-    else:
-        (host, port), path = parse_request_uri(uri)
-        if not port:
-            port = 80
-        method_args[1] = path
-        header_items[0] = ' '.join(method_args)
 
-    header_items = remore_useless_header(header_items)
-    new_header = '\r\n'.join(header_items).encode()
-    return new_header, tunnel_mode, host, port, path
+RELAY_MIN_READ = 1024 * 16
+RELAY_MAX_READ = 1024 * 256
+
+# How a negotiated connection is relayed, see `relay_with` and
+# `pipe_streams`.
+RELAY_ENGINES = ('pipe', 'splice', 'socket', 'stream')
+DEFAULT_RELAY_ENGINE = 'pipe'
 
 
 async def relay_stream(statistic,
                        reader, writer, peer_reader, peer_writer):
     async def relay(reader, reader2, writer, is_out):
+        # The read size grows while reads come back full and shrinks on
+        # short ones. Writes are drained only above the high-water mark.
+        transport = writer.transport
+        _, high_water = transport.get_write_buffer_limits()
+        size = RELAY_MIN_READ
         try:
             while True:
-                line = await reader.read(1024)
-                if len(line) == 0:
+                data = await reader.read(size)
+                if not data:
                     reader2.feed_eof()
                     break
-                writer.write(line)
-                statistic(is_out, len(line))
-                await writer.drain()
+
+                if transport.is_closing():
+                    break
+                writer.write(data)
+                statistic(is_out, len(data))
+                if transport.get_write_buffer_size() > high_water:
+                    await writer.drain()
+
+                if len(data) == size:
+                    size = min(size * 2, RELAY_MAX_READ)
+                elif len(data) < size // 4:
+                    size = max(size // 2, RELAY_MIN_READ)
         except BaseException:
             pass
 
@@ -111,35 +123,67 @@ async def relay_stream(statistic,
     )
 
 
-async def open_connection_exc(opt, host, port):
+async def relay_with(engine, statistic,
+                     reader, writer, peer_reader, peer_writer):
+    """Relay with `engine` ('stream', 'socket' or 'splice'), see
+    `pipe_streams` for 'pipe'.
+
+    The socket engines work on the raw sockets: 'socket' copies through a
+    reused buffer, 'splice' keeps the data in the kernel where `os.splice`
+    exists. Both fall back to the streams when they can not take the
+    sockets over (TLS, a proactor loop).
+    """
+    if engine != 'stream':
+        use_splice = engine == 'splice' and SPLICE_ENABLED
+        if await relay_detached(statistic, reader, writer,
+                                peer_reader, peer_writer, use_splice):
+            return
+
+    await relay_stream(statistic, reader, writer, peer_reader, peer_writer)
+
+
+async def open_connection_exc(opt, host, port, route=None):
     TIMEOUT = 10
     open_conn = opt.get('open_conn')
-    if open_conn:
-        fut = open_conn(host, port)
+    if route is not None or open_conn:
+        if route is not None:
+            fut = opt['open_route'](route, port)
+        else:
+            fut = open_conn(host, port)
         try:
             return await asyncio.wait_for(fut, TIMEOUT)
         except asyncio.TimeoutError:
             logger.warning(f'connect timeout: {host}:{port}')
     else:
-        def statistic():
+        def statistic(is_out, bytes_):
             pass
         fut = asyncio.open_connection(host, port)
         peer = await asyncio.wait_for(fut, TIMEOUT)
         return peer, statistic
 
 
+async def filter_request(reader, writer, opt, req_info):
+    header, tunnel_mode, host, port, path = req_info
+    req_filter = opt.get('req_filter')
+    if req_filter:
+        return await req_filter(
+            reader, writer, tunnel_mode, host, port, path, header)
+
+
 async def open_peer_connection(reader, writer, opt):
     req_info = await get_request_info_from_header(reader, writer)
     if req_info is None:
         return
 
+    if await filter_request(reader, writer, opt, req_info):
+        return
+
     header, tunnel_mode, host, port, path = req_info
-    req_filter = opt.get('req_filter')
-    if req_filter:
-        is_filtered = await req_filter(
-            reader, writer, tunnel_mode, host, port, path, header)
-        if is_filtered:
+    if is_forwarded(opt, tunnel_mode, header):
+        req_info = await forward_requests(reader, writer, opt, req_info)
+        if req_info is None:
             return
+        header, tunnel_mode, host, port, path = req_info
 
     result = await open_connection_exc(opt, host, port)
     if result is None:
@@ -148,6 +192,55 @@ async def open_peer_connection(reader, writer, opt):
     return peer, header, tunnel_mode, statistic
 
 
+def is_forwarded(opt, tunnel_mode, header):
+    # Upgrades ("websocket") keep the connection, they are relayed.
+    return opt.get('upstream_pool') is not None and not tunnel_mode \
+        and header.get('upgrade') is None
+
+
+async def forward_requests(reader, writer, opt, req_info):
+    """Serves the requests of a plain-HTTP client one at a time.
+
+    Each request is routed on its own and goes over an upstream
+    connection from `opt['upstream_pool']`. With `opt['route']` set, the
+    request is routed once: `route(host, port)` gives (key, route), the
+    connection is keyed by the key, the host and the port, and a new one
+    is opened by `opt['open_route'](route, port)`.
+    A later request to tunnel or upgrade is returned, to be relayed.
+    """
+    pool = opt['upstream_pool']
+    choose_route = opt.get('route')
+
+    while True:
+        header, tunnel_mode, host, port, path = req_info
+        key, route = None, None
+        if choose_route:
+            key, route = await choose_route(host, port)
+
+        def connect():
+            return open_connection_exc(opt, host, port, route)
+
+        keep_alive = await forward_request(
+            reader, writer, header, (key, host, port), connect, pool)
+        if not keep_alive:
+            return
+
+        try:
+            head = await asyncio.wait_for(
+                read_http_head(reader), KEEP_ALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, HttpHeadError):
+            return
+
+        req_info = head and get_request_info(head)
+        if req_info is None:
+            return
+        if await filter_request(reader, writer, opt, req_info):
+            return
+
+        if not is_forwarded(opt, req_info[1], req_info[0]):
+            return req_info
+
+
 async def end_negotiate(statistic, tunnel_mode, header, writer, peer_writer):
     if tunnel_mode:
         is_socks5 = header is None
@@ -157,38 +250,46 @@ async def end_negotiate(statistic, tunnel_mode, header, writer, peer_writer):
             writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
         await writer.drain()
     else:
-        peer_writer.write(header)
-        statistic(True, len(header))
+        data = header.to_bytes(RELAY_STRIP)
+        peer_writer.write(data)
+        statistic(True, len(data))
         await peer_writer.drain()
 
 
 async def server_handler_impl(reader, writer, opt):
+    """Negotiate and relay. True once pipes own both connections."""
     peer_connection = await open_peer_connection(reader, writer, opt)
     if peer_connection is None:
-        return
+        return False
 
     peer, header, tunnel_mode, statistic = peer_connection
     peer_reader, peer_writer = peer
+    engine = opt.get('relay_engine', DEFAULT_RELAY_ENGINE)
 
+    piped = False
     try:
         await end_negotiate(
             statistic, tunnel_mode, header, writer, peer_writer)
-        await relay_stream(
-            statistic, reader, writer, peer_reader, peer_writer)
+        if engine == 'pipe':
+            pipe_streams(statistic, reader, writer, peer_reader, peer_writer)
+            piped = True
+        else:
+            await relay_with(engine, statistic,
+                             reader, writer, peer_reader, peer_writer)
     finally:
-        peer_writer.close()
+        if not piped:
+            peer_writer.close()
 
+    return piped
 
-async def server_handler(reader, writer, opt):
-    routine = server_handler_impl(reader, writer, opt)
-    task = asyncio.ensure_future(routine)
-    all_clients[task] = (reader, writer)
-
-    def client_done(task):
-        del all_clients[task]
-        writer.close()
 
-    task.add_done_callback(client_done)
+async def server_handler(reader, writer, opt):
+    piped = False
+    try:
+        piped = await server_handler_impl(reader, writer, opt)
+    finally:
+        if not piped:
+            writer.close()
 
 
 class ExceptionRateLimiter:
@@ -220,6 +321,11 @@ class ExceptionRateLimiter:
 
 
 async def server_loop(host, port, opt):
+    """Accepts and negotiates on streams, as the `opt` hooks expect.
+
+    Only the relay leaves the streams: with the 'pipe' engine both
+    transports are handed to `TransportPipe` protocols once negotiated.
+    """
     exception_rate_limiter = ExceptionRateLimiter(600)
 
     def exception_handler(loop, context):
@@ -236,7 +342,8 @@ async def server_loop(host, port, opt):
     async def handler(reader, writer):
         await server_handler(reader, writer, opt)
 
-    server = await asyncio.start_server(handler, host, port)
+    server = await asyncio.start_server(
+        handler, host, port, reuse_port=opt.get('reuse_port'))
     started = opt.get('started')
     if started:
         addr = server.sockets[0].getsockname()
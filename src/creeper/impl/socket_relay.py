@@ -0,0 +1,191 @@
+import os
+import asyncio
+
+BUFFER_SIZE = 1024 * 64
+SPLICE_SIZE = 1024 * 256
+SPLICE_ENABLED = hasattr(os, 'splice')
+
+_free_buffers = []
+_free_pipes = []
+
+
+def take_buffer():
+    return _free_buffers.pop() if _free_buffers else bytearray(BUFFER_SIZE)
+
+
+def give_buffer(buffer):
+    if len(_free_buffers) < 64:
+        _free_buffers.append(buffer)
+
+
+def take_pipe():
+    return _free_pipes.pop() if _free_pipes else os.pipe()
+
+
+def give_pipe(pipe, is_empty):
+    # A pipe still holding data is of no use to another relay.
+    if is_empty and len(_free_pipes) < 64:
+        _free_pipes.append(pipe)
+    else:
+        os.close(pipe[0])
+        os.close(pipe[1])
+
+
+def detach_socket(reader, writer):
+    """A duplicate of the socket under a stream pair, with the bytes the
+    reader had buffered, or None when the stream can not be taken over.
+
+    Reading is paused on the transport and its write buffer is empty, so
+    the transport stays idle until it is closed.
+    """
+    transport = writer.transport
+    if not isinstance(asyncio.get_running_loop(), asyncio.SelectorEventLoop):
+        return  # the proactor has a read in flight
+
+    sock = transport.get_extra_info('socket')
+    if sock is None or transport.get_extra_info('ssl_object') is not None:
+        return
+
+    buffered = getattr(reader, '_buffer', None)
+    if buffered is None or reader.at_eof() or \
+            transport.get_write_buffer_size():
+        return
+
+    try:
+        raw_sock = sock.dup()
+    except OSError:
+        return  # out of descriptors, the streams need none
+
+    transport.pause_reading()
+    data = bytes(buffered)
+    buffered.clear()
+    raw_sock.setblocking(False)
+    return raw_sock, data
+
+
+async def wait_fd(fd, for_write):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    if for_write:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await future
+    finally:
+        if for_write:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def copy_recv_into(src, dst, count):
+    loop = asyncio.get_running_loop()
+    buffer = take_buffer()
+    view = memoryview(buffer)
+    try:
+        while True:
+            size = await loop.sock_recv_into(src, buffer)
+            if not size:
+                break
+            await loop.sock_sendall(dst, view[:size])
+            count(size)
+    finally:
+        view.release()
+        give_buffer(buffer)
+
+
+async def copy_splice(src, dst, count):
+    # socket => pipe => socket, the data stays in the kernel. The pipe is
+    # held only while data flows, an idle relay gives it back.
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    pipe = None
+    left = 0
+    try:
+        while True:
+            if pipe is None:
+                pipe = take_pipe()
+            try:
+                size = os.splice(src_fd, pipe[1], SPLICE_SIZE, flags=flags)
+            except BlockingIOError:
+                give_pipe(pipe, True)
+                pipe = None
+                await wait_fd(src_fd, False)
+                continue
+            if not size:
+                break
+
+            left = size
+            while left:
+                try:
+                    left -= os.splice(pipe[0], dst_fd, left, flags=flags)
+                except BlockingIOError:
+                    await wait_fd(dst_fd, True)
+            count(size)
+    finally:
+        if pipe is not None:
+            give_pipe(pipe, not left)
+
+
+async def relay_sockets(statistic, sock, peer_sock, use_splice=None):
+    """Relay two detached sockets until either side ends."""
+    if use_splice is None:
+        use_splice = SPLICE_ENABLED
+    copy = copy_splice if use_splice else copy_recv_into
+
+    async def relay(src, dst, is_out):
+        try:
+            await copy(src, dst, lambda size: statistic(is_out, size))
+        except (OSError, ValueError, asyncio.CancelledError):
+            pass  # ValueError: a socket closed under a pending wait
+
+    # As with the streams, the first direction to end stops the other.
+    tasks = [asyncio.ensure_future(relay(sock, peer_sock, True)),
+             asyncio.ensure_future(relay(peer_sock, sock, False))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def relay_detached(statistic, reader, writer, peer_reader, peer_writer,
+                         use_splice=None):
+    """Relay on the raw sockets, False if the streams can not be taken."""
+    client = detach_socket(reader, writer)
+    if client is None:
+        return False
+
+    peer = detach_socket(peer_reader, peer_writer)
+    if peer is None:
+        # Give the client side back to its stream, untouched.
+        client[0].close()
+        reader._buffer[:0] = client[1]
+        writer.transport.resume_reading()
+        return False
+
+    sock, data = client
+    peer_sock, peer_data = peer
+    loop = asyncio.get_running_loop()
+    try:
+        if data:
+            await loop.sock_sendall(peer_sock, data)
+            statistic(True, len(data))
+        if peer_data:
+            await loop.sock_sendall(sock, peer_data)
+            statistic(False, len(peer_data))
+        await relay_sockets(statistic, sock, peer_sock, use_splice)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+        peer_sock.close()
+
+    return True
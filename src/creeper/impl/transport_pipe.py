@@ -0,0 +1,91 @@
+import asyncio
+
+
+class TransportPipe(asyncio.Protocol):
+    """Takes over a transport and writes what it reads to the peer pipe.
+
+    Two of them relay a connection without any task: data goes straight
+    from `data_received` to the other transport, and a full write buffer
+    pauses reading on the other side until it drains. The relay ends, as
+    with the streams, when either side sends EOF or goes away.
+    """
+
+    def __init__(self, writer, statistic, is_out):
+        # The writer closes its transport when collected, it lives as long
+        # as the pipe does.
+        self.writer = writer
+        self.transport = writer.transport
+        self.statistic = statistic
+        self.is_out = is_out
+        self.on_close = None
+        self.peer = None
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+        self.statistic(self.is_out, len(data))
+
+    def eof_received(self):
+        pass  # the transport closes itself
+
+    def connection_lost(self, exc):
+        self.peer.transport.close()
+        self.closed()
+
+    def closed(self):
+        on_close = self.on_close
+        self.on_close = self.peer.on_close = None
+        if on_close is not None:
+            on_close()
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+
+def take_buffered(reader):
+    buffered = reader._buffer
+    data = bytes(buffered)
+    buffered.clear()
+    return data
+
+
+def pipe_streams(statistic, reader, writer, peer_reader, peer_writer,
+                 on_close=None):
+    """Relay two stream pairs by swapping their transports to pipes.
+
+    The connections are accepted and negotiated on the streams before, it
+    is the relay alone that runs without them.
+
+    The pipes own both connections from then on: the streams must not be
+    used or closed any more. `on_close` is called once the relay ends.
+    """
+    pipe = TransportPipe(writer, statistic, True)
+    peer_pipe = TransportPipe(peer_writer, statistic, False)
+    pipe.peer, peer_pipe.peer = peer_pipe, pipe
+    pipe.on_close = peer_pipe.on_close = on_close
+
+    ended = False
+    for pipe_, reader_ in ((pipe, reader), (peer_pipe, peer_reader)):
+        transport = pipe_.transport
+        transport.set_protocol(pipe_)
+        transport.resume_reading()  # the reader may have paused it
+
+        data = take_buffered(reader_)
+        if data:
+            pipe_.data_received(data)
+        if reader_.at_eof() or transport.is_closing():
+            ended = True
+
+    if ended:
+        writer.transport.close()
+        peer_writer.transport.close()
+        pipe.closed()
+        return
+
+    for pipe_ in (pipe, peer_pipe):
+        transport = pipe_.transport
+        _, high_water = transport.get_write_buffer_limits()
+        if transport.get_write_buffer_size() > high_water:
+            pipe_.pause_writing()
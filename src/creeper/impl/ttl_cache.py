@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A bounded LRU mapping whose entries also expire after their own TTL.
+
+    Expiry times are wall-clock (`time.time()`), so they stay meaningful
+    when entries are saved to disk and loaded again. With `refresh_ratio`,
+    a hit in the last part of an entry's lifetime is reported as stale so
+    the caller can refresh it before it expires.
+    """
+
+    def __init__(self, max_len, refresh_ratio=0.0):
+        self.max_len = max_len
+        self.refresh_ratio = refresh_ratio
+        self.data = OrderedDict()  # key => (value, expire_at, lifetime)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def lookup(self, key):
+        # (value, is_stale) for a hit, None for a miss.
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return
+
+        value, expire_at, lifetime = item
+        time_left = expire_at - time.time()
+        if time_left <= 0:
+            del self.data[key]
+            self.expirations += 1
+            self.misses += 1
+            return
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        is_stale = time_left < lifetime * self.refresh_ratio
+        if is_stale:
+            self.refreshes += 1
+        return value, is_stale
+
+    def get(self, key, default=None):
+        item = self.lookup(key)
+        return default if item is None else item[0]
+
+    def peek(self, key, default=None):
+        # The value unless expired, neither counted nor moved.
+        item = self.data.get(key)
+        if item is None or item[1] <= time.time():
+            return default
+        return item[0]
+
+    def time_left(self, key):
+        # Seconds until the entry expires, None without one.
+        item = self.data.get(key)
+        if item is not None:
+            return max(item[1] - time.time(), 0)
+
+    def set(self, key, value, ttl):
+        self.set_until(key, value, time.time() + ttl)
+
+    def set_until(self, key, value, expire_at):
+        lifetime = expire_at - time.time()
+        self.data[key] = (value, expire_at, lifetime)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_len:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+
+    def entries(self):
+        # (key, value, expire_at), least recently used first.
+        return [(key, value, expire_at)
+                for key, (value, expire_at, _) in self.data.items()]
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'max_len': self.max_len,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'refreshes': self.refreshes,
+        }
@@ -2,17 +2,62 @@ import asyncio
 import os
 import re
 import time
-from threading import Lock
+from dataclasses import dataclass, asdict
+from ipaddress import ip_address
 
-from expiringdict import ExpiringDict
 from creeper.log import logger
-from creeper.utils import hour_to_sec, is_ipv4
-from creeper.impl.dns_lookup import doh_lookup
-from creeper.impl.cidr_list import CIDRList
-from creeper.env import APP_CONF, PATH_RULES
+from creeper.utils import hour_to_sec, is_ipv4, is_ipv6, unbracket_host, \
+    readable_exc, fmt_exc, SingleFlight
+from creeper.impl.dns_lookup import get_doh_client, get_udp_client
+from creeper.impl.ttl_cache import TTLCache
+from creeper.proxy.rules import load_rule_set, IP_DIRECT
+from creeper.env import APP_CONF
 
 DOH_SERVERS = APP_CONF['doh']
 
+# Trusted plain DNS servers (e.g. the LAN router) asked before DoH.
+LAN_DNS_SERVERS = APP_CONF.get('lan_dns', [])
+
+RESOLVE_TIMEOUT = 30
+DOH_TIMEOUT = 10
+LAN_DNS_TIMEOUT = 2
+
+# Addresses kept per answer, as fallbacks when connecting directly.
+MAX_ADDRESSES = 8
+
+# A slower DoH server is joined by the next one after this many seconds.
+DOH_STAGGER = 0.3
+
+# A LAN server scoring worse than this (a lost race counts as slow, see
+# DnsServerStats.score) goes behind the DoH servers, and gets a new try at
+# the front every LAN_DNS_RETRY seconds.
+LAN_DNS_MAX_SCORE = 0.25
+LAN_DNS_RETRY = 60
+
+# DNS answers and domain verdicts live as long as the record TTL allows,
+# within [min_ttl, max_ttl]. Failed lookups are kept for negative_ttl.
+# A hit in the last refresh_ratio of a lifetime is refreshed in background.
+DNS_CACHE = {
+    'max_len': 10000,
+    'min_ttl': 60,
+    'max_ttl': hour_to_sec(1),
+    'negative_ttl': 30,
+    'refresh_ratio': 0.2,
+    **APP_CONF.get('dns_cache', {}),
+}
+
+# How to route while the rule lists are still loading.
+INTERIM_ROUTES = {
+    'proxy': True,
+    'direct': False,
+}
+DEFAULT_INTERIM_ROUTE = 'proxy'
+
+# A failed load of the rule lists is tried again, backing off up to the
+# longest delay.
+RULES_RETRY_MIN = 5
+RULES_RETRY_MAX = 300
+
 
 def make_domain_name_verifier():
     DOMAIN_TOKEN = re.compile(R'^[a-z0-9-]+$')
@@ -44,219 +89,487 @@ def make_domain_name_verifier():
 is_domain_name = make_domain_name_verifier()
 
 
-class HostsFile:
-    def __init__(self):
-        self.lock = Lock()
-        self.cached_stamp = 0
-        self.cached_records = {}
-        self.hosts_file = R'C:\Windows\System32\drivers\etc\hosts'
+def clamp_ttl(ttl):
+    return min(max(ttl, DNS_CACHE['min_ttl']), DNS_CACHE['max_ttl'])
 
-    def find(self, name):
-        with self.lock:
-            return self.find_impl(name)
 
-    def find_impl(self, name):
-        if not self.try_update_db():
-            return
+def default_hosts_path():
+    if os.name == 'nt':
+        root = os.environ.get('SystemRoot', R'C:\Windows')
+        return os.path.join(root, R'System32\drivers\etc\hosts')
+    return '/etc/hosts'
 
-        return self.cached_records.get(name)
 
-    def read_records(self):
-        def read_record(line):
-            data = line.split('#')[0].strip()
-            tokens = data.replace('\t', ' ').split()
-            if len(tokens) != 2:
-                return
+def parse_hosts(text):
+    # "IP name [aliases...]", IPv4 or IPv6; the first address comes first.
+    records = {}
+    for line in text.splitlines():
+        tokens = line.split('#', 1)[0].split()
+        if len(tokens) < 2:
+            continue
 
-            ip, host = tokens
-            if not is_ipv4(ip):
-                logger.debug(f'not IPv4: {ip}')
-                return
+        ip, names = tokens[0], tokens[1:]
+        if not is_ipv4(ip) and not is_ipv6(ip):
+            logger.debug(f'hosts: bad address {ip}')
+            continue
 
-            self.cached_records[host] = ip
+        for name in names:
+            addrs = records.setdefault(name.lower(), [])
+            if ip not in addrs:
+                addrs.append(ip)
 
-        with open(self.hosts_file, 'r') as file:
-            for line in file.readlines():
-                read_record(line)
+    return {name: tuple(addrs) for name, addrs in records.items()}
 
-    def try_update_db(self):
-        file_path = self.hosts_file
-        if not os.path.isfile(file_path):
-            return False
 
-        file_stat = os.stat(file_path)
-        if file_stat.st_size > 1024 * 1024 * 10:
-            logger.error(f'too large: {file_path}')
+class HostsFile:
+    """The hosts file, reloaded in the background when it changes.
+
+    Lookups read `records`, a dict that is replaced as a whole and never
+    changed in place, so they need neither a lock nor a `stat`.
+    """
+
+    MAX_SIZE = 1024 * 1024 * 10
+    CHECK_INTERVAL = 5
+
+    def __init__(self, path=None):
+        self.path = path or APP_CONF.get('hosts_file') or default_hosts_path()
+        self.stamp = None
+        self.records = {}  # name => addresses
+        self.task = None
+        self.reload_safe()
+
+    def find(self, name):
+        return self.records.get(name.lower())
+
+    def current_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def reload(self):
+        stamp = self.current_stamp()
+        if stamp == self.stamp:
             return False
 
-        stamp = os.stat(file_path).st_mtime
-        if stamp == self.cached_stamp:
-            return True
+        records = {}
+        if stamp is not None:
+            if stamp[1] > self.MAX_SIZE:
+                logger.error(f'too large: {self.path}')
+            else:
+                with open(self.path, 'r', errors='replace') as file:
+                    records = parse_hosts(file.read())
+
+        self.stamp = stamp
+        self.records = records
+        logger.debug(f'hosts: {len(records)} names from {self.path}')
+        return True
+
+    def reload_safe(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logger.warning(f'hosts: {readable_exc(e)}')
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            await loop.run_in_executor(None, self.reload_safe)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+
+@dataclass
+class DnsServerStats:
+    queries: int = 0
+    errors: int = 0
+    latency: float = None  # moving average, seconds
+    failure: float = 0.0  # moving average of failures, 0..1
+    last_error: str = None
+
+    SMOOTHING = 0.3
+    UNKNOWN_LATENCY = 0.2
+    FAILURE_PENALTY = 2.0
+
+    def on_success(self, latency):
+        self.queries += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.SMOOTHING
+        self.failure -= self.failure * self.SMOOTHING
+
+    def on_lost(self, elapsed):
+        # Cancelled after losing a race: at least this slow.
+        self.queries += 1
+        if self.latency is None or elapsed > self.latency:
+            self.on_success(elapsed)
+            self.queries -= 1
+
+    def on_error(self, exc):
+        self.queries += 1
+        self.errors += 1
+        self.last_error = fmt_exc(exc)
+        self.failure += (1 - self.failure) * self.SMOOTHING
 
-        self.cached_stamp = stamp
-        self.cached_records = {}
-        self.read_records()
+    def score(self):
+        latency = self.latency
+        if latency is None:
+            latency = self.UNKNOWN_LATENCY
+        return latency + self.failure * self.FAILURE_PENALTY
 
 
 class SafeDNS:
     def __init__(self):
         self.hosts_file = HostsFile()
-        self.resolving = set()
-        self.cache = ExpiringDict(10000, hour_to_sec(0.5))
+        self.resolving = SingleFlight(RESOLVE_TIMEOUT)
+        # domain => (addresses, TTL), or None for a failed lookup
+        self.cache = TTLCache(
+            DNS_CACHE['max_len'], DNS_CACHE['refresh_ratio'])
+        # (domain, 'A' or 'AAAA') => (addresses, TTL) or None, asked for
+        # when `cache` holds the other family only
+        self.family_cache = TTLCache(DNS_CACHE['max_len'])
+        self.server_stats = {
+            i: DnsServerStats() for i in LAN_DNS_SERVERS + DOH_SERVERS}
+        self.lan_demoted = {}  # LAN server => time.time() when demoted
 
     @staticmethod
-    def is_ipv6(host):
-        return host.startswith('[')
+    async def dns_query(host, server, qtypes=('A', 'AAAA')):
+        # The addresses of the first type in `qtypes` that has any.
+        if server in LAN_DNS_SERVERS:
+            client, timeout = get_udp_client(server), LAN_DNS_TIMEOUT
+        else:
+            client, timeout = get_doh_client(server), DOH_TIMEOUT
 
-    @staticmethod
-    async def dns_query(host, server):
-        records = await doh_lookup(host, server)
-        if not records:
-            logger.debug(f'DNS resolving failed: {host} @{server}')
+        for qtype in qtypes:
+            records = await client.query(host, qtype, timeout)
+            addrs = records.get(qtype)
+            if addrs:
+                break
+        else:
+            logger.debug(f'DNS no {"/".join(qtypes)} record: '
+                         f'{host} @{server}')
             return
 
-        type_a = records.get('A')
-        if not type_a:
-            logger.debug(f'DNS no A record: {host} @{server}')
-            return
+        addrs = tuple(addrs[:MAX_ADDRESSES])
+        logger.debug(f'DNS resolved: {host} => {addrs} @{server}')
+        return addrs, records['ttl']
+
+    async def query_server(self, domain, server, qtypes):
+        stats = self.server_stats[server]
+        begin = time.perf_counter()
+        try:
+            answer = await self.dns_query(domain, server, qtypes)
+        except asyncio.CancelledError:
+            stats.on_lost(time.perf_counter() - begin)
+            raise
+        except Exception as e:
+            logger.debug(f'DNS resolving failed: {domain} @{server}')
+            stats.on_error(e)
+            raise
+
+        stats.on_success(time.perf_counter() - begin)
+        return answer
+
+    def is_lan_leading(self, server):
+        if self.server_stats[server].score() < LAN_DNS_MAX_SCORE:
+            self.lan_demoted.pop(server, None)
+            return True
 
-        ip = type_a[0]
-        logger.debug(f'DNS resolved: {host} => {ip} @{server}')
-        return ip
+        now = time.time()
+        if now - self.lan_demoted.setdefault(server, now) > LAN_DNS_RETRY:
+            del self.lan_demoted[server]
+            return True
+        return False
+
+    def ranked_servers(self):
+        # The trusted LAN servers lead in their order, unless lagging.
+        lan, lagging = [], []
+        for server in LAN_DNS_SERVERS:
+            (lan if self.is_lan_leading(server) else lagging).append(server)
+
+        doh = sorted(DOH_SERVERS, key=lambda i: self.server_stats[i].score())
+        return lan + doh + lagging
+
+    async def race_servers(self, domain, qtypes=('A', 'AAAA')):
+        # The best server starts first, the next one joins whenever the
+        # race has no answer after DOH_STAGGER or a query fails. The first
+        # valid answer wins and the other queries are cancelled. A dead LAN
+        # server so delays a lookup by DOH_STAGGER, not LAN_DNS_TIMEOUT.
+        servers = self.ranked_servers()
+        pending = set()
+        try:
+            while servers or pending:
+                if servers:
+                    server = servers.pop(0)
+                    pending.add(asyncio.ensure_future(
+                        self.query_server(domain, server, qtypes)))
+
+                timeout = DOH_STAGGER if servers else None
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None and task.result():
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
     async def resolve(self, domain):
-        for server in DOH_SERVERS:
+        answer = await self.race_servers(domain)
+        if not answer:
+            # A failed refresh keeps the answer that is still valid.
+            if self.cache.peek(domain) is None:
+                self.cache.set(domain, None, DNS_CACHE['negative_ttl'])
+            return
+
+        addrs, ttl = answer
+        ttl = clamp_ttl(ttl)
+        self.cache.set(domain, (addrs, ttl), ttl)
+        return addrs, ttl
+
+    async def resolve_family(self, domain, qtype):
+        answer = await self.race_servers(domain, (qtype,))
+        if not answer:
+            self.family_cache.set(
+                (domain, qtype), None, DNS_CACHE['negative_ttl'])
+            return
+
+        addrs, ttl = answer
+        ttl = clamp_ttl(ttl)
+        self.family_cache.set((domain, qtype), (addrs, ttl), ttl)
+        return addrs, ttl
+
+    async def resolve_family_cached(self, domain, qtype):
+        """(addresses, TTL left) of one family, for clients asking for the
+        family that `resolve` did not keep."""
+        key = (domain, qtype)
+        item = self.family_cache.lookup(key)
+        if item is not None:
+            answer = item[0]
+        else:
             try:
-                ip = await self.dns_query(domain, server)
+                answer = await self.resolving.run(
+                    key, self.resolve_family, domain, qtype)
             except Exception:
-                continue
+                return
 
-            if ip:
-                self.cache[domain] = ip
-                return ip
+        if answer:
+            addrs, ttl = answer
+            return addrs, min(ttl, int(self.family_cache.time_left(key)))
 
-    async def resolve_cached(self, domain):
-        end_time = time.time() + 30
+    def server_status(self):
+        return {server: dict(asdict(stats), score=stats.score())
+                for server, stats in self.server_stats.items()}
+
+    def lookup_cache(self, domain):
+        # (answer, ) for a hit, None for a miss; stale hits are refreshed.
+        item = self.cache.lookup(domain)
+        if item is None:
+            return
 
-        while time.time() < end_time:
-            ip = self.cache.get(domain)
-            if ip:
-                return ip
+        answer, is_stale = item
+        if answer and is_stale:
+            self.resolving.spawn(domain, self.resolve, domain)
+        return answer,
 
-            if domain in self.resolving:
-                await asyncio.sleep(0.1)
-                continue
+    async def resolve_shared(self, domain):
+        try:
+            return await self.resolving.run(domain, self.resolve, domain)
+        except Exception:
+            return
 
-            self.resolving.add(domain)
-            try:
-                ip = await self.resolve(domain)
-            except Exception:
-                continue
-            finally:
-                self.resolving.remove(domain)
+    async def resolve_cached(self, domain):
+        hit = self.lookup_cache(domain)
+        if hit is not None:
+            return hit[0]
 
-            self.cache[domain] = ip
-            return ip
+        return await self.resolve_shared(domain)
 
     def find_local(self, host):
+        # Addresses from the hosts file, or None.
         return self.hosts_file.find(host)
 
 
-class DomainList:
-    def __init__(self, path):
-        lines = path.read_text().splitlines()
-        lines = map(str.strip, lines)
-        lines = filter(None, lines)
-        self.rules = set(lines)
-
-    def contains(self, domain):
-        parts = domain.split('.')
-        for num in range(2, len(parts) + 1):
-            subdomian = '.'.join(parts[-num:])
-            if subdomian in self.rules:
-                return True
-
-
 class Router:
     def __init__(self):
         self.LIST_MAX = 10000
         self.WAIT_TIMEOUT = 30
         self.dns = SafeDNS()
-        self.direct_ip = CIDRList(PATH_RULES / '../direct_ip.txt')
-        self.cn_ip = CIDRList(PATH_RULES / 'china_ip.txt')
-        self.gfw_ip = CIDRList(PATH_RULES / 'gfw_ip.txt')
-        self.cn_domain = DomainList(PATH_RULES / 'china_domain.txt')
-        self.gfw_domain = DomainList(PATH_RULES / 'gfw_domain.txt')
-        self.proxy_domain = set()
-        self.direct_domain = set()
-        self.determining = set()
+        self.rules = None
+        self.rules_load_time = None
+        self.load_task = None
+        self.interim_route = self.get_interim_route()
+        self.verdicts = TTLCache(  # domain => (proxy, addresses)
+            self.LIST_MAX, DNS_CACHE['refresh_ratio'])
+        self.determining = SingleFlight(self.WAIT_TIMEOUT)
 
-    def need_proxy_ip(self, ip):
-        if self.direct_ip.contains(ip):
-            return False
+    @staticmethod
+    def get_interim_route():
+        route = APP_CONF.get('rules_interim_route', DEFAULT_INTERIM_ROUTE)
+        if route not in INTERIM_ROUTES:
+            logger.warning(f'bad rules_interim_route: {route!r}, '
+                           f'using {DEFAULT_INTERIM_ROUTE!r}')
+            route = DEFAULT_INTERIM_ROUTE
+        return route
+
+    @property
+    def is_ready(self):
+        return self.rules is not None
+
+    def start_loading(self):
+        if self.load_task and not self.load_task.done():
+            self.load_task.cancel()  # may be waiting to retry
+        self.load_task = asyncio.create_task(self.load_rules())
+
+    async def load_rules(self):
+        delay = RULES_RETRY_MIN
+        while True:
+            try:
+                await self.reload_rules()
+                return
+            except Exception as e:
+                logger.error(f'load rules: {readable_exc(e)}, '
+                             f'retry in {delay}s')
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RULES_RETRY_MAX)
+
+    async def reload_rules(self):
+        loop = asyncio.get_running_loop()
+        begin = time.perf_counter()
+        rules = await loop.run_in_executor(None, load_rule_set)
+
+        # A single assignment: lookups see either the old rules or the new.
+        self.rules = rules
+        self.rules_load_time = time.perf_counter() - begin
+        dropped = self.invalidate_verdicts()
+        logger.info(f'rules loaded in {self.rules_load_time:.3f}s, '
+                    f'{dropped} cached verdicts dropped')
+        return self.rules_load_time
+
+    def invalidate_verdicts(self):
+        dropped = 0
+        for domain, (via_proxy, addrs), _ in self.verdicts.entries():
+            if self.need_proxy_ip(addrs[0]) != via_proxy:
+                self.verdicts.pop(domain)
+                dropped += 1
+
+        return dropped
+
+    def status(self):
+        return {
+            'ready': self.is_ready,
+            'load_time': self.rules_load_time,
+            'interim_route': self.interim_route,
+            'verdict_cache': self.verdicts.stats(),
+            'dns_cache': self.dns.cache.stats(),
+            'dns_servers': self.dns.server_status(),
+        }
+
+    def need_proxy_interim(self, host):
+        try:
+            if ip_address(host).is_private:
+                return False
+        except ValueError:
+            pass
 
-        if self.gfw_ip.contains(ip):
-            return True
+        return INTERIM_ROUTES[self.interim_route]
 
-        return not self.cn_ip.contains(ip)
+    def need_proxy_ip(self, ip):
+        return self.rules.ip_verdicts.lookup(ip) != IP_DIRECT
 
-    def add_domain(self, domain, ip):
-        if self.need_proxy_ip(ip):
-            self.proxy_domain.add(domain)
-            return True
-        else:
-            self.direct_domain.add(domain)
-            return False
+    def add_domain(self, domain, addrs, ttl):
+        # The first address decides, the others are connection fallbacks.
+        via_proxy = self.need_proxy_ip(addrs[0])
+        self.verdicts.set(domain, (via_proxy, addrs), clamp_ttl(ttl))
+        return via_proxy
 
-    async def need_proxy_domain(self, domain):
-        if self.cn_domain.contains(domain):
+    def known_route(self, domain):
+        # True or False when the rules or the cache decide, None otherwise.
+        if not self.is_ready:
+            return
+
+        if self.rules.cn_domain.contains(domain):
             return False
 
-        if self.gfw_domain.contains(domain):
+        if self.rules.gfw_domain.contains(domain):
             return True
 
-        end_time = time.time() + self.WAIT_TIMEOUT
-
-        while time.time() < end_time:
-            if domain in self.proxy_domain:
-                return True
-
-            if domain in self.direct_domain:
-                return False
-
-            if domain in self.determining:
-                await asyncio.sleep(0.1)
-                continue
-
-            self.determining.add(domain)
-            try:
-                ip = await self.dns.resolve(domain)
-            except Exception:
-                continue
-            finally:
-                self.determining.remove(domain)
-
-            if not ip:
-                return
-
-            return self.add_domain(domain, ip)
-
-    async def need_proxy(self, host):
+        verdict = self.verdicts.get(domain)
+        return verdict and verdict[0]
+
+    async def route_domain(self, domain):
+        if self.rules.cn_domain.contains(domain):
+            return False, None
+
+        if self.rules.gfw_domain.contains(domain):
+            return True, None
+
+        item = self.verdicts.lookup(domain)
+        if item is not None:
+            verdict, is_stale = item
+            if is_stale:
+                self.determining.spawn(domain, self.refresh_domain, domain)
+            return verdict
+
+        try:
+            return await self.determining.run(
+                domain, self.determine_domain, domain)
+        except Exception:
+            return None, None
+
+    async def determine_domain(self, domain):
+        answer = await self.dns.resolve_cached(domain)
+        if not answer:
+            return None, None
+
+        addrs, ttl = answer
+        return self.add_domain(domain, addrs, ttl), addrs
+
+    async def refresh_domain(self, domain):
+        # Bypasses the DNS cache, its answer may be as old as the verdict.
+        # Lookups made once the verdict expired join this task, so it
+        # answers as determine_domain() does.
+        answer = await self.dns.resolve(domain)
+        if not answer:
+            return None, None
+
+        addrs, ttl = answer
+        return self.add_domain(domain, addrs, ttl), addrs
+
+    async def route(self, host):
+        """`(via_proxy, addresses)`, via_proxy is None for DNS errors.
+
+        The addresses are those the decision was made on, None when the
+        rules decided by name alone.
+        """
         if host == 'localhost':
-            return False
+            return False, None
 
-        if self.dns.is_ipv6(host):
-            return False
+        host = unbracket_host(host)
+        if not self.is_ready:
+            return self.need_proxy_interim(host), None
 
-        if is_ipv4(host):
-            return self.need_proxy_ip(host)
+        if is_ipv4(host) or is_ipv6(host):
+            return self.need_proxy_ip(host), (host,)
 
-        ip = self.dns.find_local(host)
-        if ip:
-            return self.need_proxy_ip(ip)
+        addrs = self.dns.find_local(host)
+        if addrs:
+            return self.need_proxy_ip(addrs[0]), addrs
 
         # example: "hello" from chrome searching bar
         if not is_domain_name(host):
-            return None
+            return None, None
 
-        return await self.need_proxy_domain(host)
+        return await self.route_domain(host)
+
+    async def need_proxy(self, host):
+        via_proxy, _ = await self.route(host)
+        return via_proxy
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import mmap
+import hashlib
+from array import array
+from bisect import bisect_right
+
+from creeper.log import logger
+from creeper.utils import file_sha256sum
+from creeper.impl.cidr_list import CIDRList, IPMap, IntervalMap, \
+    Uint128Array, IPV4, IPV6
+from creeper.env import PATH_RULES, RULES_CACHE_DIR
+
+IP_DEFAULT = 0  # not listed anywhere, goes through the proxy
+IP_DIRECT = 1
+IP_PROXY = 2
+
+SNAPSHOT_MAGIC = b'CRPRULES'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGN = 16
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def rule_files(rules_dir=PATH_RULES):
+    return {
+        'direct_ip': rules_dir / '../direct_ip.txt',
+        'gfw_ip': rules_dir / 'gfw_ip.txt',
+        'china_ip': rules_dir / 'china_ip.txt',
+        'china_domain': rules_dir / 'china_domain.txt',
+        'gfw_domain': rules_dir / 'gfw_domain.txt',
+    }
+
+
+class DomainList:
+    """Domain suffix rules kept as a sorted list of reversed names.
+
+    The rule "example.com" is stored as "moc.elpmaxe." and a domain is
+    listed when its own reversed name plus "." starts with a stored key.
+    Keys already covered by a shorter key are dropped, so the only possible
+    match is the greatest key not above the domain: one bisect, no
+    per-label strings.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    @classmethod
+    def load(cls, path):
+        lines = path.read_text().splitlines()
+        lines = map(str.strip, lines)
+        return cls(cls.make_keys(lines))
+
+    @staticmethod
+    def make_keys(rules):
+        # Single-label rules are skipped: a match needs two labels at least.
+        keys = sorted(rule[::-1] + '.' for rule in rules if '.' in rule)
+        result = []
+        for key in keys:
+            if result and key.startswith(result[-1]):
+                continue
+            result.append(key)
+
+        return result
+
+    def __len__(self):
+        return len(self.keys)
+
+    def memory_usage(self):
+        return sys.getsizeof(self.keys) + sum(map(sys.getsizeof, self.keys))
+
+    def contains(self, domain):
+        key = domain[::-1] + '.'
+        index = bisect_right(self.keys, key) - 1
+        return index >= 0 and key.startswith(self.keys[index])
+
+
+def load_ip_verdicts(files):
+    # Order matters: the first list containing an address decides.
+    layers = [
+        (CIDRList(files['direct_ip']), IP_DIRECT),
+        (CIDRList(files['gfw_ip']), IP_PROXY),
+        (CIDRList(files['china_ip']), IP_DIRECT),
+    ]
+    return IPMap.from_layers(layers, IP_DEFAULT)
+
+
+class RuleSet:
+    def __init__(self, ip_verdicts, cn_domain, gfw_domain, mapping=None):
+        self.ip_verdicts = ip_verdicts
+        self.cn_domain = cn_domain
+        self.gfw_domain = gfw_domain
+        self.mapping = mapping  # keeps the snapshot mapped
+        self.sources = None  # rule file => SHA-256, from load_rule_set
+
+    @classmethod
+    def compile(cls, files):
+        return cls(
+            load_ip_verdicts(files),
+            DomainList.load(files['china_domain']),
+            DomainList.load(files['gfw_domain']))
+
+    def sections(self):
+        maps = self.ip_verdicts.maps
+        ipv6_bounds = maps[IPV6].bounds
+        return {
+            'ipv4_bounds': array('I', maps[IPV4].bounds),
+            'ipv4_values': array('b', maps[IPV4].values),
+            'ipv6_bounds': array('Q', ipv6_bounds.words),
+            'ipv6_values': array('b', maps[IPV6].values),
+            'china_domain': '\n'.join(self.cn_domain.keys).encode(),
+            'gfw_domain': '\n'.join(self.gfw_domain.keys).encode(),
+        }
+
+
+def _align(size):
+    return -size % SNAPSHOT_ALIGN
+
+
+def write_snapshot(path, rule_set, sources):
+    sections = rule_set.sections()
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        length = len(memoryview(data).cast('B'))
+        layout[name] = [offset, length]
+        offset += length + _align(length)
+
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'byteorder': sys.byteorder,
+        'sources': sources,
+        'sections': layout,
+    }).encode()
+
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header).to_bytes(4, 'little'))
+        f.write(header)
+        f.write(b'\0' * _align(f.tell()))
+        for data in sections.values():
+            data = memoryview(data).cast('B')
+            f.write(data)
+            f.write(b'\0' * _align(len(data)))
+
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path, sources):
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapping)
+    magic_len = len(SNAPSHOT_MAGIC)
+    if view[:magic_len] != SNAPSHOT_MAGIC:
+        raise SnapshotError('bad magic')
+
+    header_len = int.from_bytes(view[magic_len:magic_len + 4], 'little')
+    header_begin = magic_len + 4
+    header = json.loads(bytes(view[header_begin:header_begin + header_len]))
+    if header['version'] != SNAPSHOT_VERSION:
+        raise SnapshotError(f'version {header["version"]}')
+    if header['byteorder'] != sys.byteorder:
+        raise SnapshotError(f'byteorder {header["byteorder"]}')
+    if header['sources'] != sources:
+        raise SnapshotError('sources changed')
+
+    data_begin = header_begin + header_len
+    data_begin += _align(data_begin)
+
+    def section(name, format_='B'):
+        offset, length = header['sections'][name]
+        offset += data_begin
+        if offset + length > len(view):
+            raise SnapshotError(f'truncated: {name}')
+        return view[offset:offset + length].cast(format_)
+
+    def domain_list(name):
+        data = bytes(section(name)).decode()
+        return DomainList(data.split('\n') if data else [])
+
+    ip_verdicts = IPMap({
+        IPV4: IntervalMap(
+            IPV4, section('ipv4_bounds', 'I'), section('ipv4_values', 'b')),
+        IPV6: IntervalMap(
+            IPV6, Uint128Array.from_words(section('ipv6_bounds', 'Q')),
+            section('ipv6_values', 'b')),
+    })
+
+    return RuleSet(
+        ip_verdicts,
+        domain_list('china_domain'),
+        domain_list('gfw_domain'),
+        mapping)
+
+
+def snapshot_path(cache_dir, sources):
+    digest = hashlib.sha256(json.dumps(sources, sort_keys=True).encode())
+    return cache_dir / f'rules-{digest.hexdigest()[:16]}.bin'
+
+
+def remove_stale_snapshots(cache_dir, keep):
+    for path in cache_dir.glob('rules-*.bin'):
+        if path == keep:
+            continue
+        try:
+            path.unlink()
+        except OSError:
+            pass  # still mapped by another process
+
+
+def load_rule_set(rules_dir=PATH_RULES, cache_dir=RULES_CACHE_DIR):
+    files = rule_files(rules_dir)
+    sources = {name: file_sha256sum(path) for name, path in files.items()}
+    path = snapshot_path(cache_dir, sources)
+
+    try:
+        rule_set = read_snapshot(path, sources)
+        rule_set.sources = sources
+        return rule_set
+    except FileNotFoundError:
+        pass
+    except (SnapshotError, ValueError, KeyError, OSError) as e:
+        logger.warning(f'rule snapshot {path.name}: {e!r}')
+
+    rule_set = RuleSet.compile(files)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        write_snapshot(path, rule_set, sources)
+        remove_stale_snapshots(cache_dir, path)
+    except OSError as e:
+        logger.warning(f'write rule snapshot: {e!r}')
+
+    rule_set.sources = sources
+    return rule_set
@@ -1,6 +1,7 @@
 import time
 import json
 import socket
+import hashlib
 import asyncio
 import traceback
 import os.path
@@ -102,6 +103,63 @@ def write_json_file(file_, obj):
         f.write(json.dumps(obj, indent=4))
 
 
+def file_sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one task.
+
+    The first caller starts the work, later callers await the same task, and
+    its result, exception or timeout reaches every waiter at once.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.tasks = {}
+
+    def __contains__(self, key):
+        return key in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def _start(self, key, coro):
+        if self.timeout is not None:
+            coro = asyncio.wait_for(coro, self.timeout)
+
+        task = asyncio.ensure_future(coro)
+        self.tasks[key] = task
+
+        def done(task):
+            if self.tasks.get(key) is task:
+                del self.tasks[key]
+            if not task.cancelled():
+                task.exception()  # retrieved, even if nobody waits
+
+        task.add_done_callback(done)
+        return task
+
+    def spawn(self, key, func, *args):
+        # Joins the running task for `key`, or starts `func(*args)` for it.
+        task = self.tasks.get(key)
+        if task is None:
+            task = self._start(key, func(*args))
+
+        return task
+
+    async def run(self, key, func, *args):
+        # One waiter giving up must not cancel the work for the others.
+        return await asyncio.shield(self.spawn(key, func, *args))
+
+
 class AttrDict(dict):
     __slots__ = ()
     __getattr__ = dict.__getitem__
@@ -126,6 +184,20 @@ def is_ipv4(host):
     return True
 
 
+def is_ipv6(host):
+    try:
+        socket.inet_pton(socket.AF_INET6, host)
+    except socket.error:
+        return False
+    return True
+
+
+def unbracket_host(host):
+    if host.startswith('[') and host.endswith(']'):
+        return host[1:-1]
+    return host
+
+
 def fix_proxy_url(proxy):
     if IS_DEBUG and ENV_NO_BACKEND and proxy:
         return proxy.replace(':1081', ':1080')
@@ -0,0 +1,87 @@
+import os
+import sys
+import random
+import asyncio
+import ipaddress
+from pathlib import Path
+
+import pytest
+
+TOP_DIR = Path(__file__).parent.parent
+SRC_DIR = TOP_DIR / 'src'
+
+os.environ.setdefault('CREEPER_DBG_MODE', '1')  # no log files
+sys.path.insert(0, str(SRC_DIR / 'third_party'))
+sys.path.insert(0, str(SRC_DIR))
+
+# creeper.env finds the data directory next to the main script.
+import __main__  # noqa: E402
+__main__.__file__ = str(SRC_DIR / '__main__.py')
+
+
+def random_ipv4_list(count, seed=0):
+    rand = random.Random(seed)
+    return [str(ipaddress.IPv4Address(rand.getrandbits(32)))
+            for _ in range(count)]
+
+
+def random_ipv6_list(count, seed=0):
+    # Mostly global unicast (2000::/3), where the rule lists live.
+    rand = random.Random(seed)
+    return [str(ipaddress.IPv6Address(
+        (0b001 << 125 | rand.getrandbits(125))
+        if rand.random() < 0.9 else rand.getrandbits(128)))
+        for _ in range(count)]
+
+
+def random_networks(rand, count, version):
+    bits = 32 if version == 4 else 128
+    min_prefix = 8 if version == 4 else 16
+    result = []
+    for _ in range(count):
+        prefix = rand.randint(min_prefix, bits)
+        address = rand.getrandbits(bits)
+        if version == 6:
+            address = 0b001 << 125 | address >> 3
+        network = ipaddress.ip_network((address, prefix), strict=False)
+        result.append(str(network))
+
+    return result
+
+
+def write_rules(root, seed=0):
+    """Small random rule lists laid out as in data/conf/vendor, the rules
+    directory is returned."""
+    rand = random.Random(seed)
+    rules_dir = root / 'rules'
+    rules_dir.mkdir(parents=True)
+
+    def write(path, lines):
+        path.write_text('\n'.join(lines) + '\n')
+
+    def ip_lines(count):
+        return random_networks(rand, count, 4) + \
+            random_networks(rand, count // 4, 6)
+
+    write(root / 'direct_ip.txt', ip_lines(20))
+    write(rules_dir / 'gfw_ip.txt', ip_lines(200))
+    write(rules_dir / 'china_ip.txt', ip_lines(400))
+
+    def domain_lines(tld, count):
+        names = [f'{rand.getrandbits(24):x}.{tld}' for _ in range(count)]
+        # Some rules under others, and a single label that is skipped.
+        names += [f'www.{i}' for i in rand.sample(names, count // 10)]
+        return names + [tld]
+
+    write(rules_dir / 'china_domain.txt', domain_lines('cn', 300))
+    write(rules_dir / 'gfw_domain.txt', domain_lines('com', 300))
+    return rules_dir
+
+
+@pytest.fixture
+def rules_dir(tmp_path):
+    return write_rules(tmp_path / 'vendor')
+
+
+def run_async(coro, timeout=30):
+    return asyncio.run(asyncio.wait_for(coro, timeout))
@@ -0,0 +1,101 @@
+import socket
+import asyncio
+
+import pytest
+
+from creeper.impl.dns_lookup import UdpDnsClient
+from creeper.impl.dns_message import DnsMessage, make_response
+
+from conftest import run_async
+
+
+class StubDnsServer(asyncio.DatagramProtocol):
+    """A records for any name; names starting with "big" are truncated
+    over UDP and answered in full over TCP."""
+
+    def __init__(self):
+        self.transport = None
+        self.udp_queries = 0
+        self.tcp_queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    @staticmethod
+    def response(data, truncated=False):
+        query = DnsMessage(data)
+        question = query.questions[0]
+        records = [(question.name, question.type, 300, f'10.0.0.{i}')
+                   for i in range(1, 21)]
+        return make_response(query, records, truncated=truncated)
+
+    def datagram_received(self, data, addr):
+        self.udp_queries += 1
+        big = DnsMessage(data).questions[0].name.startswith('big')
+        self.transport.sendto(self.response(data, big), addr)
+
+    async def serve_tcp(self, reader, writer):
+        self.tcp_queries += 1
+        size = int.from_bytes(await reader.readexactly(2), 'big')
+        response = self.response(await reader.readexactly(size))
+        writer.write(len(response).to_bytes(2, 'big') + response)
+        await writer.drain()
+        writer.close()
+
+
+def with_stub(test):
+    async def main():
+        loop = asyncio.get_running_loop()
+        transport, stub = await loop.create_datagram_endpoint(
+            StubDnsServer, local_addr=('127.0.0.1', 0))
+        port = transport.get_extra_info('sockname')[1]
+        tcp_server = await asyncio.start_server(
+            stub.serve_tcp, '127.0.0.1', port)
+        client = UdpDnsClient(f'127.0.0.1:{port}', max_inflight=8)
+        try:
+            return await test(client), stub
+        finally:
+            await client.close()
+            tcp_server.close()
+            transport.close()
+
+    return run_async(main())
+
+
+def test_concurrent_queries_get_their_answers():
+    async def test(client):
+        return await asyncio.gather(*[
+            client.query(f'host{i}.example.com') for i in range(100)])
+
+    results, stub = with_stub(test)
+    assert all(len(i['A']) == 20 for i in results)
+    assert stub.udp_queries == 100
+
+
+def test_truncated_answer_is_asked_again_over_tcp():
+    async def test(client):
+        return await client.query('big.example.com')
+
+    result, stub = with_stub(test)
+    assert len(result['A']) == 20
+    assert (stub.udp_queries, stub.tcp_queries) == (1, 1)
+
+
+def test_closed_port_fails_fast():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    server = f'127.0.0.1:{sock.getsockname()[1]}'
+    sock.close()
+
+    async def main():
+        client = UdpDnsClient(server)
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        try:
+            with pytest.raises(ConnectionError):
+                await client.query('example.com', timeout_sec=2.0)
+        finally:
+            await client.close()
+        return loop.time() - begin
+
+    assert run_async(main()) < 1.0
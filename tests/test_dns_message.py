@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from creeper.impl.dns_message import DnsMessage, DnsFormatError, \
+    MessageWriter, HEADER, QUERY_TYPES, FLAG_QR, FLAG_RD, make_query, \
+    make_response
+
+
+def dns_corpus():
+    """(name, message, expected result or None for malformed) triples."""
+    A, CNAME, AAAA = (QUERY_TYPES[i] for i in ('A', 'CNAME', 'AAAA'))
+    flags = FLAG_QR | FLAG_RD
+
+    def response(qname, qtype, records):
+        writer = MessageWriter()
+        writer.add_question(qname, qtype)
+        for record in records:
+            writer.add_record(*record)
+        return writer.to_bytes(0x1234, flags)
+
+    corpus = [
+        ('A', response('www.example.com', A, [
+            ('www.example.com', A, 300, '93.184.216.34'),
+            ('www.example.com', A, 60, '93.184.216.35'),
+        ]), {'A': ['93.184.216.34', '93.184.216.35'], 'ttl': 60}),
+        ('round robin', response('cdn.example.net', A, [
+            ('cdn.example.net', A, 60, f'198.51.100.{i}') for i in range(8)
+        ]), {'A': [f'198.51.100.{i}' for i in range(8)], 'ttl': 60}),
+        ('AAAA', response('ipv6.example.com', AAAA, [
+            ('ipv6.example.com', AAAA, 120, '2001:db8::1'),
+        ]), {'AAAA': ['2001:db8::1'], 'ttl': 120}),
+        # The A owner points into the CNAME data, which points again.
+        ('nested CNAME chain', response('www.example.com', A, [
+            ('www.example.com', CNAME, 600, 'cdn.example.com'),
+            ('cdn.example.com', CNAME, 500, 'edge.cdn.example.com'),
+            ('edge.cdn.example.com', A, 30, '203.0.113.7'),
+        ]), {'CNAME': ['cdn.example.com', 'edge.cdn.example.com'],
+             'A': ['203.0.113.7'], 'ttl': 30}),
+        ('unknown type', response('example.com', A, [
+            ('example.com', 16, 300, b'\x05hello'),
+        ]), {}),
+        ('NXDOMAIN', HEADER.pack(0x1234, flags | 3, 1, 0, 0, 0) +
+            b'\x07missing\x07example\x00\x00\x01\x00\x01', {}),
+        ('pointer loop', HEADER.pack(0x1234, flags, 1, 0, 0, 0) +
+            b'\xc0\x0c\x00\x01\x00\x01', None),
+        ('forward pointer', HEADER.pack(0x1234, flags, 1, 0, 0, 0) +
+            b'\xc0\x10\x00\x01\x00\x01\x01a\x00', None),
+        ('label past end', HEADER.pack(0x1234, flags, 1, 0, 0, 0) +
+            b'\x3fabc', None),
+        ('short header', b'\x12\x34\x81', None),
+        ('truncated answer', response('example.com', A, [
+            ('example.com', A, 300, '1.2.3.4'),
+        ])[:-1], None),
+        ('bad A length', response('example.com', A, [
+            ('example.com', 99, 300, b'\x01\x02\x03'),
+        ]).replace(b'\x00\x63', b'\x00\x01'), None),
+    ]
+    return corpus
+
+
+def fuzz_dns(corpus, rounds, seed=0):
+    def parse(data):
+        try:
+            return DnsMessage(data).to_result()
+        except DnsFormatError:
+            return
+
+    rand = random.Random(seed)
+    seeds = [message for _, message, _ in corpus]
+    for _ in range(rounds):
+        data = bytearray(rand.choice(seeds))
+        for _ in range(rand.randint(1, 4)):
+            action = rand.random()
+            pos = rand.randrange(len(data))
+            if action < 0.5:
+                data[pos] = rand.getrandbits(8)
+            elif action < 0.7:
+                data[pos] = 0xc0 | rand.getrandbits(6)
+            elif action < 0.9:
+                del data[pos:]
+            else:
+                data[pos:pos] = rand.randbytes(rand.randint(1, 8))
+            if not data:
+                data.append(0)
+        parse(bytes(data))  # anything but DnsFormatError is a bug
+
+
+CORPUS = dns_corpus()
+
+
+@pytest.mark.parametrize('name, message, expected', CORPUS,
+                         ids=[i[0] for i in CORPUS])
+def test_corpus(name, message, expected):
+    try:
+        result = DnsMessage(message).to_result()
+    except DnsFormatError:
+        result = None
+    assert result == expected
+
+
+def test_fuzz_raises_only_format_errors():
+    fuzz_dns(CORPUS, 20000)
+
+
+def test_response_round_trip():
+    query = DnsMessage(make_query('www.example.com', 'AAAA', 0x4321))
+    records = [('www.example.com', QUERY_TYPES['AAAA'], 90, '2001:db8::7')]
+    response = DnsMessage(make_response(query, records))
+
+    assert response.is_response and response.id == 0x4321
+    assert response.to_result() == {'AAAA': ['2001:db8::7'], 'ttl': 90}
+    assert DnsMessage(make_response(query, truncated=True)).is_truncated
@@ -0,0 +1,64 @@
+from creeper.proxy.router import Router, SafeDNS
+from creeper.impl.dns_lookup import DnsResolver
+from creeper.impl.dns_message import RCODE_REFUSED
+from creeper.components.dns_server import DnsServer
+
+from conftest import run_async
+
+RECORDS = {
+    'dual.example': {'A': ['192.0.2.1'], 'AAAA': ['2001:db8::1']},
+    'v6only.example': {'AAAA': ['2001:db8::2']},
+}
+
+
+def make_server(monkeypatch):
+    queries = []
+
+    async def dns_query(host, server, qtypes=('A', 'AAAA')):
+        queries.append((host, qtypes))
+        for qtype in qtypes:
+            addrs = RECORDS.get(host, {}).get(qtype)
+            if addrs:
+                return tuple(addrs), 300
+
+    monkeypatch.setattr(SafeDNS, 'dns_query', staticmethod(dns_query))
+    return DnsServer(Router()), queries
+
+
+def ask(server, domain, qtype):
+    resolver = DnsResolver(domain, qtype, 7)
+    data = run_async(server.handle(resolver.request, '127.0.0.1'))
+    return resolver.parse(data)
+
+
+def test_both_families_of_a_cached_name(monkeypatch):
+    server, queries = make_server(monkeypatch)
+    assert ask(server, 'dual.example', 'A')['A'] == ['192.0.2.1']
+    assert ask(server, 'dual.example', 'AAAA')['AAAA'] == ['2001:db8::1']
+    assert ask(server, 'dual.example', 'AAAA')['AAAA'] == ['2001:db8::1']
+    assert ask(server, 'dual.example', 'A')['A'] == ['192.0.2.1']
+
+    # Each family asked upstream once, then answered from the caches.
+    assert queries == [('dual.example', ('A', 'AAAA')),
+                       ('dual.example', ('AAAA',))]
+    assert server.stats.family_lookups == 2
+
+
+def test_missing_family_is_an_empty_answer(monkeypatch):
+    server, queries = make_server(monkeypatch)
+    assert ask(server, 'v6only.example', 'AAAA')['AAAA'] == ['2001:db8::2']
+    assert ask(server, 'v6only.example', 'A') == {}
+    asked = len(queries)
+    assert ask(server, 'v6only.example', 'A') == {}
+
+    # Every server was asked for IPv4, then the empty answer was cached.
+    assert queries[0] == ('v6only.example', ('A', 'AAAA'))
+    assert set(queries[1:]) == {('v6only.example', ('A',))}
+    assert len(queries) == asked
+
+
+def test_other_types_are_refused(monkeypatch):
+    server, _ = make_server(monkeypatch)
+    resolver = DnsResolver('dual.example', 'CNAME', 7)
+    data = run_async(server.handle(resolver.request, '127.0.0.1'))
+    assert data[3] & 0x0f == RCODE_REFUSED
@@ -0,0 +1,308 @@
+import asyncio
+
+import pytest
+
+from creeper.impl import http_proxy
+from creeper.impl.http_forward import UpstreamPool
+
+from conftest import run_async
+
+
+class Origin:
+    """A keep-alive HTTP server answering "<name>:<path>:<body size>",
+    which records the request heads it gets."""
+
+    def __init__(self, name, close_after=False):
+        self.name = name
+        self.close_after = close_after  # drops each connection silently
+        self.heads = []
+        self.connections = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def read_body(self, reader, head):
+        if b'\r\ntransfer-encoding: chunked\r\n' in head.lower():
+            body = b''
+            while True:
+                size = int((await reader.readuntil(b'\r\n'))[:-2], 16)
+                body += (await reader.readexactly(size + 2))[:-2]
+                if not size:  # no trailer fields
+                    return body
+        for line in head.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.lower() == b'content-length':
+                return await reader.readexactly(int(value))
+        return b''
+
+    def response(self, head, body):
+        path = head.split(b' ')[1].decode()
+        if path == '/chunked':
+            return (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    b'3\r\nabc\r\n2;x=1\r\nde\r\n0\r\nX-T: 1\r\n\r\n')
+        if path == '/bad-chunk':
+            return (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    b'3\r\nabc\r\nzz\r\n')
+        if head.startswith(b'HEAD'):
+            return b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n'
+        data = f'{self.name}:{path}:{len(body)}'.encode()
+        return b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(data), data)
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                self.heads.append(head)
+                body = await self.read_body(reader, head)
+                writer.write(self.response(head, body))
+                await writer.drain()
+                if self.close_after:
+                    await asyncio.sleep(0.05)
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+async def start_proxy(pool, **extra):
+    started = asyncio.get_running_loop().create_future()
+    opt = {
+        'started': lambda server, addr: started.set_result(addr[1]),
+        'upstream_pool': pool,
+        **extra,
+    }
+    task = asyncio.ensure_future(http_proxy.server_loop('127.0.0.1', 0, opt))
+    return task, await started
+
+
+async def read_response(reader, method='GET'):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode()
+    if method == 'HEAD':
+        return head, b''
+    if 'chunked' in head:
+        return head, await reader.readuntil(b'0\r\nX-T: 1\r\n\r\n')
+    for line in head.split('\r\n'):
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            return head, await reader.readexactly(int(value))
+    return head, await reader.read()
+
+
+def with_proxy(test, *origins, pool=None, **extra):
+    async def main():
+        pool_ = pool or UpstreamPool()
+        for origin in origins:
+            await origin.start()
+        task, port = await start_proxy(pool_, **extra)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            return await test(reader, writer, pool_)
+        finally:
+            writer.close()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            pool_.close()
+            for origin in origins:
+                origin.server.close()
+
+    return run_async(main())
+
+
+def request(method, origin, path, fields='', body=b''):
+    return (f'{method} http://127.0.0.1:{origin.port}{path} HTTP/1.1\r\n'
+            f'Host: 127.0.0.1\r\n{fields}\r\n').encode() + body
+
+
+def test_requests_on_one_connection_go_to_their_hosts():
+    a, b = Origin('A'), Origin('B')
+
+    async def test(reader, writer, pool):
+        results = []
+        for origin, path in ((a, '/1'), (b, '/2'), (a, '/3'), (b, '/4')):
+            writer.write(request('GET', origin, path))
+            results.append((await read_response(reader))[1])
+
+        writer.write(request('GET', a, '/5', 'Connection: close\r\n'))
+        head, body = await read_response(reader)
+        assert 'Connection: close' in head
+        assert await reader.read() == b''
+        return results + [body], pool.status()
+
+    results, status = with_proxy(test, a, b)
+    assert results == [b'A:/1:0', b'B:/2:0', b'A:/3:0', b'B:/4:0', b'A:/5:0']
+    assert (a.connections, b.connections) == (1, 1)
+    assert status['hits'] == 3
+    assert all(b'Proxy-Connection' not in i for i in a.heads)
+
+
+def test_body_framing():
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        writer.write(request('POST', a, '/len', 'Content-Length: 5\r\n',
+                             b'hello'))
+        by_length = await read_response(reader)
+        writer.write(request('GET', a, '/chunked'))
+        chunked = await read_response(reader)
+        writer.write(request('HEAD', a, '/head'))
+        head = await read_response(reader, 'HEAD')
+        writer.write(request('GET', a, '/after'))
+        return by_length, chunked, head, await read_response(reader)
+
+    by_length, chunked, head, after = with_proxy(test, a)
+    assert by_length[1] == b'A:/len:5'
+    assert 'Transfer-Encoding: chunked' in chunked[0]
+    assert chunked[1] == b'3\r\nabc\r\n2;x=1\r\nde\r\n0\r\nX-T: 1\r\n\r\n'
+    assert 'Content-Length: 100' in head[0]
+    assert after[1] == b'A:/after:0'
+
+
+def test_chunked_request_drops_content_length():
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        writer.write(request(
+            'POST', a, '/', 'Content-Length: 5\r\n'
+            'Transfer-Encoding: chunked\r\n', b'3\r\nabc\r\n0\r\n\r\n'))
+        return await read_response(reader)
+
+    _, body = with_proxy(test, a)
+    assert body == b'A:/:3'
+    assert b'content-length' not in a.heads[0].lower()
+
+
+def test_unknown_transfer_coding_is_refused():
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        writer.write(request('POST', a, '/', 'Transfer-Encoding: gzip\r\n'))
+        return await read_response(reader)
+
+    head, _ = with_proxy(test, a)
+    assert head.startswith('HTTP/1.1 400 ')
+    assert a.heads == []
+
+
+@pytest.mark.parametrize('body', [
+    b'zz\r\n',                      # not a size
+    b'-3\r\nabc\r\n0\r\n\r\n',       # a size int() would take
+    b'3\r\nab',                       # cut short
+    b'3' * (1024 * 128),              # no end of line
+])
+def test_bad_chunked_request_body(body):
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        writer.write(request(
+            'POST', a, '/', 'Transfer-Encoding: chunked\r\n', body))
+        writer.write_eof()
+        head, _ = await read_response(reader)
+        return head, await reader.read()
+
+    head, rest = with_proxy(test, a)
+    assert head.startswith('HTTP/1.1 400 ')
+    assert rest == b''
+
+
+def test_bad_chunked_response_body_closes_the_client():
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        writer.write(request('GET', a, '/bad-chunk'))
+        head = await reader.readuntil(b'\r\n\r\n')
+        return head, await reader.read(), pool.status()
+
+    head, rest, status = with_proxy(test, a)
+    assert head.startswith(b'HTTP/1.1 200 ')
+    assert rest == b'3\r\nabc\r\n'
+    assert status['idle'] == 0
+
+
+def test_requests_are_routed_once():
+    a = Origin('A')
+    routed, opened = [], []
+
+    async def route(host, port):
+        routed.append((host, port))
+        return 'direct', ('direct', host)
+
+    async def open_route(route, port):
+        opened.append(route)
+        peer = await asyncio.open_connection(route[1], port)
+        return peer, lambda is_out, size: None
+
+    async def test(reader, writer, pool):
+        for path in ('/1', '/2', '/3'):
+            writer.write(request('GET', a, path))
+            await read_response(reader)
+        return pool.status()
+
+    status = with_proxy(test, a, route=route, open_route=open_route)
+    assert routed == [('127.0.0.1', a.port)] * 3
+    assert opened == [('direct', '127.0.0.1')]
+    assert status['hits'] == 2
+
+
+def test_closed_pooled_connection_is_retried():
+    a = Origin('A', close_after=True)
+
+    async def test(reader, writer, pool):
+        results = []
+        for path in ('/1', '/2'):
+            writer.write(request('GET', a, path))
+            results.append((await read_response(reader))[1])
+        return results, pool.status()
+
+    results, status = with_proxy(test, a)
+    assert results == [b'A:/1:0', b'A:/2:0']
+    assert a.connections == 2
+    assert status['hits'] == 1
+
+
+def test_non_idempotent_requests_take_no_pooled_connection():
+    a = Origin('A')
+
+    async def test(reader, writer, pool):
+        for _ in range(2):
+            writer.write(request('POST', a, '/'))
+            await read_response(reader)
+        return pool.status()
+
+    status = with_proxy(test, a)
+    assert a.connections == 2
+    assert (status['hits'], status['misses']) == (0, 0)
+
+
+def test_pool_limits():
+    async def main():
+        pool = UpstreamPool(max_per_key=1, max_idle=2)
+        writers = []
+
+        async def connection():
+            server = await asyncio.start_server(
+                lambda r, w: None, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            peer = await asyncio.open_connection('127.0.0.1', port)
+            writers.append(peer[1])
+            server.close()
+            return peer[0], peer[1], None
+
+        pool.give('a', await connection())
+        pool.give('a', await connection())  # over max_per_key
+        pool.give('b', await connection())
+        pool.give('c', await connection())  # over max_idle
+        idle = {key: len(entries) for key, entries in pool.idle.items()}
+        taken = pool.take('a')
+        pool.close()
+        return idle, taken, [i.is_closing() for i in writers]
+
+    idle, taken, closing = run_async(main())
+    assert idle == {'a': 1, 'b': 1}
+    assert taken is not None  # taken out, it is no longer the pool's
+    assert closing == [False, True, True, True]
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from creeper.impl.http_head import HttpHead, HttpResponseHead, \
+    HttpHeadError, read_http_head, HEAD_LIMIT, HOP_BY_HOP
+
+from conftest import run_async
+
+
+def parse(text):
+    return HttpHead.parse(text.encode('latin-1'))
+
+
+def read(data, limit=HEAD_LIMIT):
+    async def main():
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_http_head(reader)
+
+    return run_async(main())
+
+
+def test_request_head():
+    head = parse('GET http://example.com/a?b=1 HTTP/1.1\r\n'
+                 'Host: example.com\r\nX-A: 1\r\nx-a: 2\r\n'
+                 'Proxy-Connection: keep-alive\r\n\r\n')
+    assert (head.method, head.target, head.version) == \
+        ('GET', 'http://example.com/a?b=1', 'HTTP/1.1')
+    assert head.get('HOST') == 'example.com'
+    assert head.get('x-a') == '1; 2'
+    assert head.to_bytes(HOP_BY_HOP, [('Connection', 'close')]) == (
+        b'GET http://example.com/a?b=1 HTTP/1.1\r\nConnection: close\r\n'
+        b'Host: example.com\r\nX-A: 1\r\nx-a: 2\r\n\r\n')
+
+
+def test_head_bytes_round_trip():
+    data = 'GET / HTTP/1.1\r\nX-Name: caf\xe9\r\n\r\n'.encode('latin-1')
+    assert HttpHead.parse(data).to_bytes() == data
+
+
+@pytest.mark.parametrize('text', [
+    'GET /\r\n\r\n',
+    'GET / HTTP/1.1\r\nNo colon\r\n\r\n',
+    'GET / HTTP/1.1\r\n: empty name\r\n\r\n',
+])
+def test_bad_request_head(text):
+    with pytest.raises(HttpHeadError):
+        parse(text)
+
+
+@pytest.mark.parametrize('version, connection, keep_alive', [
+    ('HTTP/1.1', None, True),
+    ('HTTP/1.1', 'close', False),
+    ('HTTP/1.1', 'Keep-Alive, Close', False),
+    ('HTTP/1.0', None, False),
+    ('HTTP/1.0', 'keep-alive', True),
+])
+def test_keep_alive(version, connection, keep_alive):
+    text = f'GET / {version}\r\n'
+    if connection:
+        text += f'Connection: {connection}\r\n'
+    assert parse(text + '\r\n').keep_alive() == keep_alive
+
+
+def test_hop_by_hop_names_from_connection():
+    head = parse('GET / HTTP/1.1\r\nConnection: X-Private\r\n\r\n')
+    assert 'x-private' in head.hop_by_hop()
+    assert 'connection' in head.hop_by_hop()
+
+
+@pytest.mark.parametrize('fields, length', [
+    ('', None),
+    ('Content-Length: 12\r\n', 12),
+    ('Content-Length: 12\r\nContent-Length: 12\r\n', 12),
+])
+def test_content_length(fields, length):
+    assert parse(f'POST / HTTP/1.1\r\n{fields}\r\n').content_length() == \
+        length
+
+
+@pytest.mark.parametrize('fields', [
+    'Content-Length: 12\r\nContent-Length: 13\r\n',
+    'Content-Length: -1\r\n',
+    'Content-Length: 0x10\r\n',
+])
+def test_bad_content_length(fields):
+    with pytest.raises(HttpHeadError):
+        parse(f'POST / HTTP/1.1\r\n{fields}\r\n').content_length()
+
+
+@pytest.mark.parametrize('coding, chunked', [
+    ('chunked', True),
+    ('gzip, chunked', True),
+    ('chunked, gzip', False),
+])
+def test_is_chunked(coding, chunked):
+    head = parse(f'POST / HTTP/1.1\r\nTransfer-Encoding: {coding}\r\n\r\n')
+    assert head.is_chunked() == chunked
+
+
+def test_response_head():
+    head = HttpResponseHead.parse(
+        b'HTTP/1.1 404 Not Found\r\nContent-Length: 3\r\n\r\n')
+    assert (head.version, head.status, head.reason) == \
+        ('HTTP/1.1', 404, 'Not Found')
+    assert head.content_length() == 3
+    assert head.to_bytes().startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+    with pytest.raises(HttpHeadError):
+        HttpResponseHead.parse(b'HTTP/1.1 OK\r\n\r\n')
+
+
+def test_read_http_head():
+    head = read(b'GET / HTTP/1.1\r\nHost: a\r\n\r\nbody')
+    assert head.get('host') == 'a'
+    assert read(b'GET / HTTP/1.1\r\nHost: a\r\n') is None
+    with pytest.raises(HttpHeadError):
+        read(b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * 100, limit=256)
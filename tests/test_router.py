@@ -0,0 +1,59 @@
+import asyncio
+
+from creeper.proxy import router
+from creeper.proxy.router import Router
+
+from conftest import run_async
+
+
+def test_bad_interim_route_falls_back_to_proxy(monkeypatch):
+    monkeypatch.setitem(router.APP_CONF, 'rules_interim_route', 'nowhere')
+    router_ = Router()
+    assert router_.interim_route == 'proxy'
+    assert router_.need_proxy_interim('example.com') is True
+    assert router_.need_proxy_interim('192.168.1.1') is False
+
+
+def test_interim_route_from_conf(monkeypatch):
+    monkeypatch.setitem(router.APP_CONF, 'rules_interim_route', 'direct')
+    assert Router().need_proxy_interim('example.com') is False
+
+
+def test_failed_rules_loading_is_retried(monkeypatch, rules_dir, tmp_path):
+    calls = []
+    load_rule_set_ = router.load_rule_set
+
+    def load_rule_set():
+        calls.append(None)
+        if len(calls) < 3:
+            raise OSError('not yet')
+        return load_rule_set_(rules_dir, tmp_path / 'cache')
+
+    monkeypatch.setattr(router, 'load_rule_set', load_rule_set)
+    monkeypatch.setattr(router, 'RULES_RETRY_MIN', 0.01)
+
+    async def main():
+        router_ = Router()
+        router_.start_loading()
+        await router_.load_task
+        return router_
+
+    router_ = run_async(main())
+    assert len(calls) == 3
+    assert router_.is_ready
+
+
+def test_loading_again_cancels_a_pending_retry(monkeypatch):
+    monkeypatch.setattr(router, 'load_rule_set', lambda: 1 / 0)
+
+    async def main():
+        router_ = Router()
+        router_.start_loading()
+        first = router_.load_task
+        await asyncio.sleep(0.05)  # failed, waiting to retry
+        router_.start_loading()
+        await asyncio.sleep(0)
+        router_.load_task.cancel()
+        return first
+
+    assert run_async(main()).cancelled()
@@ -0,0 +1,124 @@
+import random
+import ipaddress
+
+import pytest
+
+from creeper.impl.cidr_list import CIDRList, IPV4, IPV6
+from creeper.proxy.rules import DomainList, RuleSet, rule_files, \
+    load_ip_verdicts, load_rule_set, IP_DIRECT
+
+from conftest import random_ipv4_list, random_ipv6_list
+
+
+def read_networks(path):
+    lines = filter(None, map(str.strip, path.read_text().splitlines()))
+    return [ipaddress.ip_network(i, strict=False) for i in lines]
+
+
+def boundary_addresses(cidr_lists):
+    # Both sides of every range edge, where an index is most likely off.
+    addresses = []
+    for family, to_str in ((IPV4, ipaddress.IPv4Address),
+                           (IPV6, ipaddress.IPv6Address)):
+        nums = set()
+        for cidr_list in cidr_lists:
+            for start, end in cidr_list.ranges(family):
+                nums.update((start - 1, start, end, end + 1))
+        addresses += [str(to_str(i)) for i in nums
+                      if 0 <= i <= family.max_value]
+
+    return addresses
+
+
+def test_cidr_list_matches_ipaddress(rules_dir):
+    path = rules_dir / 'china_ip.txt'
+    cidr_list = CIDRList(path)
+    networks = read_networks(path)
+
+    addresses = random_ipv4_list(2000) + random_ipv6_list(2000) + \
+        boundary_addresses([cidr_list])
+    for ip in addresses:
+        address = ipaddress.ip_address(ip)
+        expected = any(address in i for i in networks)
+        assert cidr_list.contains(ip) == expected, ip
+
+
+@pytest.mark.parametrize('ip', ['10.1', '127.1', '1.2.3.256', '1.2.3.4/8',
+                                'example.com', '::g', ''])
+def test_address_parsing_is_strict(ip):
+    family = IPV6 if ':' in ip else IPV4
+    with pytest.raises(ValueError):
+        family.to_int(ip)
+
+
+def test_verdict_map_matches_three_lists(rules_dir):
+    files = rule_files(rules_dir)
+    direct_ip = CIDRList(files['direct_ip'])
+    gfw_ip = CIDRList(files['gfw_ip'])
+    cn_ip = CIDRList(files['china_ip'])
+    ip_verdicts = load_ip_verdicts(files)
+
+    def three_lists(ip):
+        if direct_ip.contains(ip):
+            return False
+
+        if gfw_ip.contains(ip):
+            return True
+
+        return not cn_ip.contains(ip)
+
+    addresses = random_ipv4_list(5000) + random_ipv6_list(5000) + \
+        boundary_addresses([direct_ip, gfw_ip, cn_ip])
+    for ip in addresses:
+        assert (ip_verdicts.lookup(ip) != IP_DIRECT) == three_lists(ip), ip
+
+
+def test_domain_list_matches_suffix_set(rules_dir):
+    path = rules_dir / 'gfw_domain.txt'
+    rules = set(filter(None, path.read_text().split()))
+    domain_list = DomainList.load(path)
+
+    def suffix_set(domain):
+        parts = domain.split('.')
+        return any('.'.join(parts[-num:]) in rules
+                   for num in range(2, len(parts) + 1))
+
+    rand = random.Random(0)
+    listed = sorted(rules)
+    domains = ['com', 'x.com', 'wwwcom.com']
+    for _ in range(5000):
+        if rand.random() < 0.5:
+            domain = rand.choice(listed)
+        else:
+            domain = f'{rand.getrandbits(24):x}.{rand.choice(["com", "cn"])}'
+        domains.append(rand.choice(['', 'www.', 'a.b.', 'x']) + domain)
+
+    for domain in domains:
+        assert domain_list.contains(domain) == suffix_set(domain), domain
+
+
+def test_snapshot_matches_compiled_rules(rules_dir, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    compiled = RuleSet.compile(rule_files(rules_dir))
+    load_rule_set(rules_dir, cache_dir)  # compiles and writes
+    rule_set = load_rule_set(rules_dir, cache_dir)
+
+    assert rule_set.mapping is not None
+    assert set(rule_set.sources) == set(rule_files(rules_dir))
+    for ip in random_ipv4_list(2000) + random_ipv6_list(2000):
+        assert rule_set.ip_verdicts.lookup(ip) == \
+            compiled.ip_verdicts.lookup(ip), ip
+    assert rule_set.cn_domain.keys == compiled.cn_domain.keys
+    assert rule_set.gfw_domain.keys == compiled.gfw_domain.keys
+
+
+def test_snapshot_follows_rule_changes(rules_dir, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    old = load_rule_set(rules_dir, cache_dir)
+    assert not old.gfw_domain.contains('changed.example')
+
+    (rules_dir / 'gfw_domain.txt').write_text('changed.example\n')
+    new = load_rule_set(rules_dir, cache_dir)
+    assert new.gfw_domain.contains('changed.example')
+    assert new.sources != old.sources
+    assert len(list(cache_dir.glob('rules-*.bin'))) == 1
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from creeper.utils import now
+from creeper.impl.ttl_cache import TTLCache
+from creeper.components.warm_cache import WarmCache
+
+from conftest import run_async
+
+
+def make_router():
+    dns = SimpleNamespace(cache=TTLCache(100))
+    return SimpleNamespace(dns=dns, verdicts=TTLCache(100), load_task=None,
+                           is_ready=False)
+
+
+def make_cache(tmp_path):
+    router = make_router()
+    expire_at = now() + 600
+    router.dns.cache.set_until(
+        'a.example', (('192.0.2.1',), 600), expire_at)
+    router.verdicts.set_until(
+        'b.example', (True, ('192.0.2.2',)), expire_at)
+    return WarmCache(router, tmp_path / 'warm_cache.bin')
+
+
+def test_entries_survive_a_restart(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.loaded = True
+    cache.save()
+
+    router = make_router()
+    domains = WarmCache(router, cache.path).load()
+    assert domains == ['b.example']
+    assert router.dns.cache.peek('a.example')[0] == ('192.0.2.1',)
+    assert router.verdicts.peek('b.example') == (True, ('192.0.2.2',))
+
+
+def test_nothing_is_saved_before_loading(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.save_safe()
+    assert not cache.path.exists()
+
+
+def test_save_from_thread_without_a_running_loop(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.loaded = True
+    cache.save_from_thread(None)
+    assert cache.path.exists()
+
+
+def test_save_from_thread_runs_on_the_loop(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.loaded = True
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        thread = threading.Thread(target=cache.save_from_thread,
+                                  args=(loop,))
+        thread.start()
+        while thread.is_alive():
+            await asyncio.sleep(0.01)
+
+    run_async(main())
+    assert cache.path.exists()